@@ -0,0 +1,232 @@
+"""Load benchmark for PersonalServer engines.
+
+Starts the server in a child process for each engine, hammers it from a pool of
+client threads and reports requests/sec, latency percentiles and peak RSS.
+
+    python3 bench.py --engines threaded asyncio --requests 5000 --concurrency 500
+    python3 bench.py --connection both --path /weights --body '{"weight": 80}'
+    python3 bench.py --workers 4 --connection keep-alive
+    python3 bench.py --transport tcp unix --connection keep-alive
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection over a Unix domain socket."""
+
+    def __init__(self, path: str, timeout: float = 30):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+def _connect(port: int, unix_path: Optional[str]) -> http.client.HTTPConnection:
+    if unix_path:
+        return UnixHTTPConnection(unix_path, timeout=30)
+    return http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+
+def _wait_ready(port: int, unix_path: Optional[str] = None, deadline: float = 10.0) -> None:
+    end = time.time() + deadline
+    while time.time() < end:
+        try:
+            if unix_path:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                    s.connect(unix_path)
+            else:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                    pass
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server on {unix_path or port} did not start")
+
+
+def _process_tree(pid: int) -> List[int]:
+    # The server process plus prefork workers (Linux only)
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [pid] + [int(c) for c in f.read().split()]
+    except OSError:
+        return [pid]
+
+
+def _sum(values: List[Optional[int]]) -> Optional[int]:
+    known = [v for v in values if v is not None]
+    return sum(known) if known else None
+
+
+def _peak_rss_kb(pid: int) -> Optional[int]:
+    # VmHWM is the high-water mark of resident memory (Linux only)
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _thread_count(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _client(
+    port: int,
+    unix_path: Optional[str],
+    method: str,
+    path: str,
+    body: Optional[bytes],
+    count: int,
+    keep_alive: bool,
+    latencies: List[float],
+    errors: List[int],
+) -> None:
+    headers = {"Content-Type": "application/json", "Connection": "keep-alive" if keep_alive else "close"}
+    conn: Optional[http.client.HTTPConnection] = None
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            # http.client reconnects by itself when the server closes a kept-alive socket
+            if conn is None or not keep_alive:
+                conn = _connect(port, unix_path)
+            conn.request(method, path, body=body, headers=headers)
+            conn.getresponse().read()
+            if not keep_alive:
+                conn.close()
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors.append(1)
+            if conn is not None:
+                conn.close()
+            conn = None
+    if conn is not None:
+        conn.close()
+
+
+def bench_engine(
+    engine: str,
+    requests: int,
+    concurrency: int,
+    method: str,
+    path: str,
+    body: Optional[bytes],
+    keep_alive: bool = False,
+    workers: int = 1,
+    transport: str = "tcp",
+) -> Dict:
+    port = _free_port()
+    data_root = tempfile.mkdtemp(prefix="ps-bench-")
+    unix_path = os.path.join(data_root, "server.sock") if transport == "unix" else None
+    env = dict(os.environ)
+    env.update(
+        PERSONAL_SERVER_ENGINE=engine,
+        PERSONAL_SERVER_PORT=str(port),
+        PERSONAL_SERVER_WORKERS=str(workers),
+        PERSONAL_SERVER_ROOT=data_root,
+    )
+    if unix_path:
+        env.update(PERSONAL_SERVER_UNIX_SOCKET=unix_path, PERSONAL_SERVER_TCP="0")
+    root = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(root, "main.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_ready(port, unix_path)
+        latencies: List[float] = []
+        errors: List[int] = []
+        per_client = max(1, requests // concurrency)
+        threads = [
+            threading.Thread(target=_client, args=(port, unix_path, method, path, body, per_client, keep_alive, latencies, errors))
+            for _ in range(concurrency)
+        ]
+        peak_threads = 0
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        while any(t.is_alive() for t in threads):
+            peak_threads = max(peak_threads, _sum([_thread_count(p) for p in _process_tree(proc.pid)]) or 0)
+            time.sleep(0.05)
+        elapsed = time.perf_counter() - start
+
+        peak_rss = _sum([_peak_rss_kb(p) for p in _process_tree(proc.pid)])
+        latencies.sort()
+        n = len(latencies)
+        return {
+            "engine": engine,
+            "transport": transport,
+            "workers": workers,
+            "connection": "keep-alive" if keep_alive else "close",
+            "requests": n,
+            "errors": len(errors),
+            "rps": round(n / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(latencies[n // 2] * 1000, 2) if n else None,
+            "p99_ms": round(latencies[min(n - 1, int(n * 0.99))] * 1000, 2) if n else None,
+            "peak_rss_kb": peak_rss,
+            "peak_threads": peak_threads,
+        }
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--engines", nargs="+", default=["threaded", "asyncio"])
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--concurrency", type=int, default=200)
+    ap.add_argument("--path", default="/ping")
+    ap.add_argument("--body", default=None, help="JSON body; switches the request method to POST")
+    ap.add_argument("--workers", type=int, default=1, help="prefork server processes")
+    ap.add_argument("--connection", choices=["close", "keep-alive", "both"], default="close")
+    ap.add_argument("--transport", nargs="+", choices=["tcp", "unix"], default=["tcp"])
+    args = ap.parse_args(argv)
+
+    method = "POST" if args.body else "GET"
+    body = json.dumps(json.loads(args.body)).encode("utf-8") if args.body else None
+    modes = [False, True] if args.connection == "both" else [args.connection == "keep-alive"]
+    for engine in args.engines:
+        for transport in args.transport:
+            for keep_alive in modes:
+                result = bench_engine(
+                    engine, args.requests, args.concurrency, method, args.path, body, keep_alive, args.workers, transport
+                )
+                print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,17 @@
+import argparse
+
 from personal_server.server import run_server
 
 
 if __name__ == "__main__":
-    # Defaults: host 127.0.0.1, port 8080
-    run_server()
-
+    # Defaults: host 127.0.0.1, port 8080 (or the PERSONAL_SERVER_* environment)
+    ap = argparse.ArgumentParser(description="PersonalServer")
+    ap.add_argument("--host", default=None)
+    ap.add_argument("--port", type=int, default=None)
+    ap.add_argument("--engine", choices=["threaded", "asyncio"], default=None)
+    ap.add_argument("--workers", type=int, default=None, help="prefork N server processes sharing the port")
+    ap.add_argument("--unix-socket", default=None, help="also listen on this Unix domain socket path")
+    ap.add_argument("--unix-socket-mode", type=lambda v: int(v, 8), default=None, help="octal permissions, e.g. 660")
+    ap.add_argument("--no-tcp", dest="tcp", action="store_false", default=None, help="serve the Unix socket only")
+    args = ap.parse_args()
+    run_server(args.host, args.port, args.engine, args.workers, args.unix_socket, args.unix_socket_mode, args.tcp)
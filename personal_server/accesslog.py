@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import config
+from .utils import lock_file, unlock_file
+
+
+class AccessLog:
+    """JSON-lines access log written by a background thread.
+
+    Request threads only build a dict and `put_nowait` it; the writer drains the
+    queue in batches, writes each batch with one `write()` call and rotates the
+    file by size. If the writer falls behind, records are dropped (and counted)
+    instead of blocking requests.
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path],
+        sample_rate: float = 1.0,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 5,
+        queue_size: int = 10000,
+        batch_size: int = 512,
+        flush_interval: float = 0.5,
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self.written = 0
+        self._queue: "queue.Queue[Optional[Dict]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._file = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None and self.sample_rate > 0
+
+    def record(
+        self,
+        client: str,
+        method: str,
+        path: str,
+        route: str,
+        status: int,
+        bytes_in: int,
+        bytes_out: int,
+        seconds: float,
+    ) -> None:
+        if not self.enabled:
+            return
+        # Errors are always kept; everything else is sampled
+        if status < 500 and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+        entry = {
+            "ts": time.time(),
+            "client": client,
+            "method": method,
+            "path": path,
+            "route": route,
+            "status": int(status),
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "duration_ms": round(seconds * 1000, 3),
+        }
+        self.enqueue(entry)
+
+    def enqueue(self, entry: Dict) -> None:
+        """Queue one JSON line; `entry["ts"]` is a `time.time()` value."""
+        if self.path is None:
+            return
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ps-accesslog", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch: List[Dict] = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            stop = item is None
+            if not stop:
+                batch.append(item)
+            while not stop and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                self._write(batch)
+            if stop:
+                self._close_file()
+                return
+
+    def _write(self, batch: List[Dict]) -> None:
+        lines = []
+        for entry in batch:
+            entry["ts"] = datetime.fromtimestamp(entry["ts"], timezone.utc).isoformat(timespec="milliseconds")
+            lines.append(json.dumps(entry, ensure_ascii=False))
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        try:
+            f = self._open()
+            # Prefork workers share the file: write and rotate under an flock
+            lock_file(f)
+            try:
+                if self._rotated_elsewhere(f):
+                    unlock_file(f)
+                    self._close_file()
+                    f = self._open()
+                    lock_file(f)
+                size = f.seek(0, os.SEEK_END)
+                if self.max_bytes and size + len(data) > self.max_bytes and size > 0:
+                    self._rotate()
+                    f = self._open()
+                    lock_file(f)
+                f.write(data)
+                f.flush()
+            finally:
+                if self._file is not None:
+                    unlock_file(self._file)
+            self.written += len(batch)
+        except OSError:
+            self.dropped += len(batch)
+
+    def _rotated_elsewhere(self, f) -> bool:
+        try:
+            return os.stat(self.path).st_ino != os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _open(self):
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.path.open("ab")
+        return self._file
+
+    def _close_file(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _rotate(self) -> None:
+        # Rename while still holding the lock on the old file, then let it go
+        for i in range(self.backup_count - 1, 0, -1):
+            src = self.path.with_name(f"{self.path.name}.{i}")
+            if src.exists():
+                os.replace(src, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+        self._close_file()
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Flush queued records and stop the writer."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+
+ACCESS_LOG = AccessLog(
+    config.ACCESS_LOG_PATH,
+    sample_rate=config.ACCESS_LOG_SAMPLE_RATE,
+    max_bytes=config.ACCESS_LOG_MAX_BYTES,
+    backup_count=config.ACCESS_LOG_BACKUPS,
+)
+
+# Span trees of requests slower than SLOW_REQUEST_MS (see tracing.py)
+SLOW_LOG = AccessLog(
+    config.SLOW_LOG_PATH if config.SLOW_REQUEST_MS > 0 else None,
+    max_bytes=config.ACCESS_LOG_MAX_BYTES,
+    backup_count=config.ACCESS_LOG_BACKUPS,
+)
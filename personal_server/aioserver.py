@@ -0,0 +1,437 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import os
+import signal
+import socket
+import sys
+import time
+from concurrent.futures import Executor
+from email.utils import formatdate
+from http import HTTPStatus
+from email.parser import Parser
+from http.client import HTTPMessage
+from typing import Any, Awaitable, Dict, List, Optional, Tuple, TypeVar
+
+from . import config, metrics
+from .accesslog import ACCESS_LOG, SLOW_LOG
+from .bodies import BodyError, body_framing
+from .bulkhead import BulkheadFull, shutdown_all
+from .commands import terminate_all
+from .jobs import JOBS
+from .sessions import SESSIONS
+from .router import JSON_CONTENT_TYPE, HTTPError, Request, Response, busy, close_body, error_response
+from .routes import router
+
+
+class AsyncServer:
+    """Single event loop HTTP/1.1 engine serving the same routes as `Handler`.
+
+    Connections are cheap coroutines; route handlers (which block) run on each
+    route's bounded bulkhead executor so a burst of clients never turns into a
+    burst of threads.
+    """
+
+    server_version = "PersonalServer/0.1"
+
+    def __init__(
+        self,
+        host: Optional[str],
+        port: int,
+        reuse_port: bool = False,
+        unix_sock: Optional[socket.socket] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.unix_sock = unix_sock
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._unix_server: Optional[asyncio.AbstractServer] = None
+        self.connections = 0
+        self.draining = False
+        # Insertion-ordered, so the first key is the longest-idle connection
+        self._idle: Dict[asyncio.StreamWriter, float] = {}
+        self.max_idle = 1024 if config.MAX_IDLE_CONNECTIONS is None else config.MAX_IDLE_CONNECTIONS
+
+    async def start(self) -> None:
+        if self.unix_sock is not None:
+            # The socket file belongs to run_server (and may be shared by prefork workers)
+            keep_file = {"cleanup_socket": False} if sys.version_info >= (3, 13) else {}
+            self._unix_server = await asyncio.start_unix_server(self._handle_conn, sock=self.unix_sock, **keep_file)
+        if self.host:
+            self._server = await asyncio.start_server(
+                self._handle_conn, self.host, self.port, reuse_port=self.reuse_port or None
+            )
+            sock = self._server.sockets[0]
+            self.host, self.port = sock.getsockname()[:2]
+
+    @property
+    def addresses(self) -> List[str]:
+        out = [f"http://{self.host}:{self.port}"] if self._server is not None else []
+        if self._unix_server is not None:
+            out.append(f"unix:{self.unix_sock.getsockname()}")
+        return out
+
+    async def serve_forever(self) -> None:
+        if self._server is None and self._unix_server is None:
+            await self.start()
+        await asyncio.gather(*(s.serve_forever() for s in (self._server, self._unix_server) if s is not None))
+
+    def _stop_listening(self) -> None:
+        for server in (self._server, self._unix_server):
+            if server is not None:
+                server.close()
+
+    def close(self) -> None:
+        self._stop_listening()
+        JOBS.shutdown()
+        SESSIONS.shutdown()
+        shutdown_all()
+
+    async def drain(self, timeout: float) -> bool:
+        """Stop accepting and wait up to `timeout` for open connections to finish.
+
+        Idle keep-alive connections are closed; busy ones answer with
+        `Connection: close`. Returns False if requests were still running at the deadline.
+        """
+        self.draining = True
+        self._stop_listening()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            for writer in list(self._idle):
+                writer.close()
+            if self.connections == 0:
+                return True
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(0.05)
+
+    async def _handle_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+        served = 0
+        self.connections += 1
+        try:
+            while not self.draining:
+                self._mark_idle(writer)
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), config.KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    metrics.CONNECTIONS_REAPED.inc("idle_timeout")
+                    break
+                finally:
+                    self._idle.pop(writer, None)
+                if not request_line.endswith(b"\n"):
+                    break
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    bad = Response({"ok": False, "error": "Bad request line"}, status=HTTPStatus.BAD_REQUEST)
+                    await self._send(writer, bad, False, chunked=False)
+                    break
+                method, target, version = parts
+                try:
+                    # A total deadline, however slowly the header lines trickle in
+                    headers = await asyncio.wait_for(self._read_headers(reader), config.HEADER_TIMEOUT)
+                except asyncio.TimeoutError:
+                    metrics.CONNECTIONS_REAPED.inc("header_timeout")
+                    break
+
+                start = time.perf_counter()
+                served += 1
+                keep_alive = self._keep_alive(version, headers.get("Connection", ""))
+                keep_alive = keep_alive and served < config.KEEPALIVE_MAX_REQUESTS
+                # Unix socket peers have no address
+                client = peer[0] if isinstance(peer, tuple) else "unix"
+                # The client holds the body back until it is told to send it
+                expect = version == "HTTP/1.1" and headers.get("Expect", "").lower() == "100-continue"
+                request, response, reusable = await self._dispatch(
+                    method, target, headers, reader, client, writer if expect else None
+                )
+                keep_alive = keep_alive and reusable and not self.draining
+                # HTTP/1.0 clients get a close-delimited body instead of chunks
+                chunked = version == "HTTP/1.1"
+                if response.stream and not chunked:
+                    keep_alive = False
+                # A bulkheaded route's body is produced on its own threads, not the shared default executor
+                executor = request.route.limit.executor if request.route and request.route.limit else None
+                sent, complete = await self._send(
+                    writer, response, keep_alive, config.KEEPALIVE_MAX_REQUESTS - served, chunked, executor
+                )
+                keep_alive = keep_alive and complete
+                route = request.route.name if request.route else "unmatched"
+                elapsed = time.perf_counter() - start
+                metrics.observe_request(route, method, response.status, elapsed)
+                ACCESS_LOG.record(
+                    client,
+                    method,
+                    target,
+                    route,
+                    response.status,
+                    request.bytes_read,
+                    sent,
+                    elapsed,
+                )
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            self._idle.pop(writer, None)
+            writer.close()
+
+    def _mark_idle(self, writer: asyncio.StreamWriter) -> None:
+        now = time.monotonic()
+        self._idle[writer] = now
+        if self.max_idle and len(self._idle) > self.max_idle:
+            # Over the cap: close the longest-idle connection (its readline sees EOF), unless it
+            # went idle moments ago and its client is likely sending the next request
+            oldest, since = next(iter(self._idle.items()))
+            if now - since >= 0.25:
+                del self._idle[oldest]
+                metrics.CONNECTIONS_REAPED.inc("idle_limit")
+                oldest.close()
+
+    async def _read_headers(self, reader: asyncio.StreamReader) -> HTTPMessage:
+        # Same parser http.server uses, so handlers see identical header objects
+        lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n"):
+                break
+            if not line.endswith(b"\n"):
+                raise ConnectionError("connection closed inside the request headers")
+            lines.append(line)
+        return Parser(_class=HTTPMessage).parsestr(b"".join(lines).decode("iso-8859-1"))
+
+    @staticmethod
+    def _keep_alive(version: str, connection: str) -> bool:
+        connection = connection.lower()
+        if version == "HTTP/1.1":
+            return connection != "close"
+        return connection == "keep-alive"
+
+    async def _dispatch(
+        self,
+        method: str,
+        target: str,
+        headers: HTTPMessage,
+        reader: asyncio.StreamReader,
+        client: str,
+        expect_continue: Optional[asyncio.StreamWriter] = None,
+    ) -> Tuple[Request, Response, bool]:
+        """Route and run one request; the flag says whether the connection can be reused.
+
+        With `expect_continue` (the client sent `Expect: 100-continue`), `100 Continue`
+        is written to it once the route, rate limit and body size are accepted; a
+        request refused before that never has its body sent or read.
+        """
+        request = Request(method, target, headers, client=client, server=self)
+        try:
+            route = router.match(request)
+        except HTTPError as e:
+            route, not_found = None, e
+        try:
+            length, chunked = body_framing(headers)
+        except BodyError:
+            length, chunked = 0, True
+        # A refused request whose body is still to come (or was never sent) leaves the connection unusable
+        no_body = not chunked and length == 0
+
+        quota: Dict[str, str] = {}
+        if route is not None:
+            try:
+                quota = route.admit(request)
+            except HTTPError as e:
+                # Throttled before reading the body; a connection with one left on the wire is closed
+                return request, error_response(e), no_body
+        if expect_continue is not None and not no_body:
+            if route is None:
+                return request, error_response(not_found), False
+            if not chunked and length > request.max_body:
+                too_large = HTTPError(
+                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                    f"Request body too large ({length} > {request.max_body} bytes)",
+                )
+                return request, error_response(too_large), False
+            expect_continue.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+            await _drain(expect_continue)
+
+        # Always consume the body so a pipelined follow-up request starts at the right offset.
+        # It is buffered (bounded by the route's limit) because handlers run off the loop.
+        try:
+            raw = await self._read_body(reader, headers, request.max_body)
+        except BodyError as e:
+            return request, error_response(HTTPError(e.status, e.message)), False
+        request.rfile = io.BytesIO(raw)
+
+        if route is None:
+            return request, error_response(not_found), True
+        if route.limit is None:
+            response = route.invoke(request)
+        else:
+            try:
+                response = await asyncio.wrap_future(route.limit.submit(route.invoke, request))
+            except BulkheadFull:
+                response = error_response(busy(route))
+        response.headers.update(quota)
+        return request, response, True
+
+    @staticmethod
+    async def _read_body(reader: asyncio.StreamReader, headers: HTTPMessage, limit: int) -> bytes:
+        length, chunked = body_framing(headers)
+        if not chunked:
+            if length > limit:
+                raise BodyError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Request body too large ({length} > {limit} bytes)")
+            return await _body_read(reader.readexactly(length)) if length else b""
+
+        # Keep the chunk framing; Request.stream() decodes it again from memory
+        parts = []
+        total = 0
+        while True:
+            line = await _body_read(reader.readline())
+            parts.append(line)
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise BodyError(HTTPStatus.BAD_REQUEST, "Malformed chunk size")
+            if size == 0:
+                while True:
+                    trailer = await _body_read(reader.readline())
+                    parts.append(trailer)
+                    if not trailer.strip():
+                        return b"".join(parts)
+            total += size
+            if total > limit:
+                raise BodyError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Request body too large (> {limit} bytes)")
+            parts.append(await _body_read(reader.readexactly(size + 2)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "engine": "asyncio",
+            "pid": os.getpid(),
+            "connections": self.connections,
+            "draining": self.draining,
+            "idle_connections": len(self._idle),
+        }
+
+    async def _send(
+        self,
+        writer: asyncio.StreamWriter,
+        response: Response,
+        keep_alive: bool,
+        remaining: int = 0,
+        chunked: bool = True,
+        executor: Optional[Executor] = None,
+    ) -> Tuple[int, bool]:
+        """Write `response`; returns (body bytes sent, whether the body went out completely)."""
+        status = HTTPStatus(response.status)
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Server: {self.server_version}\r\n"
+            f"Date: {formatdate(usegmt=True)}\r\n"
+            f"Content-Type: {response.content_type or JSON_CONTENT_TYPE}\r\n"
+        )
+        if response.stream:
+            data = b""
+            if chunked:
+                head += "Transfer-Encoding: chunked\r\n"
+        else:
+            data = response.encode()
+            head += f"Content-Length: {len(data)}\r\n"
+        for name, value in response.headers.items():
+            head += f"{name}: {value}\r\n"
+        if keep_alive:
+            head += f"Connection: keep-alive\r\nKeep-Alive: timeout={int(config.KEEPALIVE_TIMEOUT)}, max={remaining}\r\n\r\n"
+        else:
+            head += "Connection: close\r\n\r\n"
+        writer.write(head.encode("latin-1") + data)
+        await _drain(writer)
+        if not response.stream:
+            return len(data), True
+
+        # The body iterator may block (disk, subprocess pipes), so pull chunks off the loop
+        loop = asyncio.get_running_loop()
+        chunks = response.chunks()
+        sent = 0
+        try:
+            while True:
+                chunk = await loop.run_in_executor(executor, next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                    sent += len(chunk)
+                    await _drain(writer)
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception:
+            return sent, False
+        finally:
+            # Stops a producer such as a streamed command once the client is gone
+            if not chunks.gi_running:
+                close_body(chunks)
+        if chunked:
+            writer.write(b"0\r\n\r\n")
+            await _drain(writer)
+        return sent, True
+
+T = TypeVar("T")
+
+
+async def _body_read(read: Awaitable[T]) -> T:
+    # Per-read inactivity limit: a client that stops sending mid-body gets a 408
+    try:
+        return await asyncio.wait_for(read, config.BODY_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.CONNECTIONS_REAPED.inc("body_timeout")
+        raise BodyError(HTTPStatus.REQUEST_TIMEOUT, "Timed out reading request body")
+
+
+async def _drain(writer: asyncio.StreamWriter) -> None:
+    # A client that stops reading would otherwise park this coroutine (and its buffers) forever
+    try:
+        await asyncio.wait_for(writer.drain(), config.WRITE_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.CONNECTIONS_REAPED.inc("write_timeout")
+        writer.transport.abort()
+        raise ConnectionError("write timed out")
+
+
+def run_async_server(
+    host: str | None = None,
+    port: int | None = None,
+    reuse_port: bool = False,
+    unix_sock: Optional[socket.socket] = None,
+):
+    """`host=None` with a `unix_sock` serves the Unix socket alone."""
+    if host is None and unix_sock is None:
+        host = config.DEFAULT_HOST
+    server = AsyncServer(host, port or config.DEFAULT_PORT, reuse_port=reuse_port, unix_sock=unix_sock)
+
+    async def main():
+        await server.start()
+        print(f"PersonalServer (asyncio) running on {', '.join(server.addresses)}")
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # no loop signal support (Windows, non-main thread): KeyboardInterrupt still works
+        await stop.wait()
+        print("\nShutting down...")
+        if not await server.drain(config.SHUTDOWN_GRACE_SEC):
+            # Deadline passed: stop running commands so their requests can still answer
+            await loop.run_in_executor(None, terminate_all, config.SHUTDOWN_KILL_GRACE_SEC)
+            await server.drain(config.SHUTDOWN_KILL_GRACE_SEC)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("\nShutting down...")
+    finally:
+        server.close()
+        ACCESS_LOG.close()
+        SLOW_LOG.close()
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+from typing import BinaryIO, Iterator, Mapping, Optional, Tuple
+
+from .metrics import CONNECTIONS_REAPED
+
+
+class BodyError(Exception):
+    """Malformed or oversized request body; `status` is the HTTP status to answer with."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def body_framing(headers: Mapping[str, str]) -> Tuple[int, bool]:
+    """Return (content_length, chunked) for a request's headers."""
+    te = (headers.get("Transfer-Encoding") or "").lower()
+    if te:
+        if te.replace(" ", "").split(",")[-1] != "chunked":
+            raise BodyError(501, f"Unsupported Transfer-Encoding: {te}")
+        return 0, True
+    raw = headers.get("Content-Length")
+    if not raw:
+        return 0, False
+    try:
+        length = int(raw)
+    except ValueError:
+        raise BodyError(400, "Invalid Content-Length")
+    if length < 0:
+        raise BodyError(400, "Invalid Content-Length")
+    return length, False
+
+
+class BodyReader:
+    """Incremental reader over one request body on a blocking stream.
+
+    Handles both Content-Length and chunked framing and never lets more than
+    `limit` body bytes through: a declared length over the limit fails before
+    anything is read, a chunked body fails as soon as it crosses the limit.
+    A socket read timeout (the client stopped sending) becomes a 408.
+    """
+
+    def __init__(self, rfile: BinaryIO, length: int, chunked: bool, limit: int):
+        if not chunked and length > limit:
+            raise BodyError(413, f"Request body too large ({length} > {limit} bytes)")
+        self._rfile = rfile
+        self._chunked = chunked
+        self._remaining = length
+        self._chunk_left = 0
+        self._eof = not chunked and length == 0
+        self._timed_out = False
+        self.limit = limit
+        self.consumed = 0
+
+    @property
+    def remaining(self) -> Optional[int]:
+        """Bytes left on the wire, or None when unknown (chunked)."""
+        if self._eof:
+            return 0
+        return None if self._chunked else self._remaining
+
+    def _read(self, n: int, line: bool = False) -> bytes:
+        # A socket file cannot be read again after a timeout
+        if self._timed_out:
+            raise BodyError(408, "Timed out reading request body")
+        try:
+            return self._rfile.readline(n) if line else self._rfile.read(n)
+        except TimeoutError:
+            self._timed_out = True
+            CONNECTIONS_REAPED.inc("body_timeout")
+            raise BodyError(408, "Timed out reading request body")
+
+    def _next_chunk(self) -> None:
+        line = self._read(1024, line=True)
+        if not line.endswith(b"\n"):
+            raise BodyError(400, "Malformed chunk header")
+        try:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise BodyError(400, "Malformed chunk size")
+        if size == 0:
+            # Skip optional trailers up to the terminating blank line
+            while self._read(8192, line=True).strip():
+                pass
+            self._eof = True
+        self._chunk_left = size
+
+    def _available(self) -> int:
+        if self._eof:
+            return 0
+        if not self._chunked:
+            return self._remaining
+        if self._chunk_left == 0:
+            self._next_chunk()
+        return self._chunk_left
+
+    def _account(self, data: bytes) -> bytes:
+        self.consumed += len(data)
+        if self.consumed > self.limit:
+            raise BodyError(413, f"Request body too large (> {self.limit} bytes)")
+        if self._chunked:
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                self._read(8, line=True)  # CRLF after chunk data
+        else:
+            self._remaining -= len(data)
+            if self._remaining == 0:
+                self._eof = True
+        return data
+
+    def read(self, n: int = -1) -> bytes:
+        if n is None or n < 0:
+            parts = []
+            while True:
+                piece = self.read(65536)
+                if not piece:
+                    return b"".join(parts)
+                parts.append(piece)
+        avail = self._available()
+        if avail == 0:
+            return b""
+        want = min(n, avail)
+        data = self._read(want)
+        if len(data) < want:
+            raise BodyError(400, "Incomplete request body")
+        return self._account(data)
+
+    def readline(self) -> bytes:
+        parts = []
+        while True:
+            avail = self._available()
+            if avail == 0:
+                break
+            want = min(avail, 65536)
+            piece = self._read(want, line=True)
+            if len(piece) < want and not piece.endswith(b"\n"):
+                raise BodyError(400, "Incomplete request body")
+            self._account(piece)
+            parts.append(piece)
+            if piece.endswith(b"\n"):
+                break
+        return b"".join(parts)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def discard(self, max_bytes: int = 65536) -> bool:
+        """Skip what is left of the body so the connection can carry another request.
+
+        Gives up (returning False) rather than read more than `max_bytes`.
+        """
+        remaining = self.remaining
+        if remaining is not None and remaining > max_bytes:
+            return False
+        skipped = 0
+        try:
+            while True:
+                piece = self.read(min(65536, max_bytes - skipped + 1))
+                if not piece:
+                    return True
+                skipped += len(piece)
+                if skipped > max_bytes:
+                    return False
+        except BodyError:
+            return False
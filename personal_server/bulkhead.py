@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from . import config
+
+
+class BulkheadFull(Exception):
+    """Raised when a route already has its maximum of running + queued calls."""
+
+
+class _Slot:
+    """One admitted call's place in a bulkhead; released exactly once."""
+
+    def __init__(self, bulkhead: "Bulkhead", run: bool):
+        self.bulkhead = bulkhead
+        self.run = run
+        self.detached = False
+        self.held = True
+
+    def release(self) -> None:
+        with self.bulkhead._lock:
+            if not self.held:
+                return
+            self.held = False
+        if self.run:
+            self.bulkhead._run.release()
+        self.bulkhead._leave()
+
+    def __del__(self) -> None:
+        # A detached slot whose streamed body was dropped unsent (never started, so no finally ran)
+        self.release()
+
+
+class Bulkhead:
+    """Concurrency limit plus bounded queue for one route.
+
+    `call` runs the function on the calling thread if a slot is free right now
+    (used by the threaded engine, whose worker already is a dedicated thread): a
+    caller left waiting would hold one of the server's worker threads, so a flood
+    on one route could starve every other, and it is rejected instead; `queue`
+    only applies to `submit`, which hands the function to the route's own executor
+    (used by the asyncio engine). A handler whose work continues after it returns
+    (a streamed body) keeps its slot with `detach`.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self._admit = threading.BoundedSemaphore(concurrency + queue)
+        self._run = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.concurrency,
+                        thread_name_prefix=f"ps-{self.name.strip('/')}",
+                    )
+        return self._executor
+
+    def _enter(self) -> None:
+        if not self._admit.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise BulkheadFull(self.name)
+        with self._lock:
+            self.waiting += 1
+
+    def _reject(self) -> None:
+        # Undo `_enter` for a caller that will not wait
+        with self._lock:
+            self.waiting -= 1
+            self.rejected += 1
+        self._admit.release()
+        raise BulkheadFull(self.name)
+
+    def _start(self) -> None:
+        with self._lock:
+            self.waiting -= 1
+            self.active += 1
+
+    def _leave(self) -> None:
+        with self._lock:
+            self.active -= 1
+            self.completed += 1
+        self._admit.release()
+
+    def _hold(self, slot: _Slot, fn: Callable[..., Any], args: tuple) -> Any:
+        outer = getattr(self._local, "slot", None)
+        self._local.slot = slot
+        try:
+            result = fn(*args)
+        except BaseException:
+            slot.release()
+            raise
+        finally:
+            self._local.slot = outer
+        if not slot.detached:
+            slot.release()
+        return result
+
+    def call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        self._enter()
+        if not self._run.acquire(blocking=False):
+            self._reject()
+        self._start()
+        return self._hold(_Slot(self, run=True), fn, args)
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        self._enter()
+
+        def task():
+            self._start()
+            return self._hold(_Slot(self, run=False), fn, args)
+
+        return self.executor.submit(task)
+
+    def detach(self) -> Callable[[], None]:
+        """Keep the slot held by the current call past its return; the returned function frees it.
+
+        The release function may be called from any thread, and more than once.
+        """
+        slot: Optional[_Slot] = getattr(self._local, "slot", None)
+        if slot is None:
+            raise RuntimeError(f"No {self.name} call is running on this thread")
+        slot.detached = True
+        return slot.release
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "queue": self.queue,
+                "active": self.active,
+                "waiting": self.waiting,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_bulkheads: Dict[str, Bulkhead] = {
+    route: Bulkhead(route, concurrency, queue) for route, (concurrency, queue) in config.ROUTE_LIMITS.items()
+}
+
+
+def get_bulkhead(path: str) -> Optional[Bulkhead]:
+    """Return the bulkhead guarding `path` (matched on its first segment), if any."""
+    route = "/" + path.lstrip("/").split("/", 1)[0].split("?", 1)[0]
+    return _bulkheads.get(route)
+
+
+def all_stats() -> Dict[str, Dict[str, int]]:
+    return {route: b.stats() for route, b in _bulkheads.items()}
+
+
+def shutdown_all() -> None:
+    for b in _bulkheads.values():
+        b.shutdown()
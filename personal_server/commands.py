@@ -1,25 +1,110 @@
 from __future__ import annotations
 
+import codecs
+import selectors
+import signal
 import subprocess
+import threading
 import time
 import os
 import uuid
-from typing import Dict, Optional, List
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, List, Set, Tuple
+
+from . import config, tracing
+from .metrics import COMMAND_SECONDS
+
+
+# Shell processes currently running, so shutdown can stop their process groups
+_running: Set[subprocess.Popen] = set()
+_running_lock = threading.Lock()
+
+# Long-lived threads for parallel command lists and step graphs, shared by every request; each request
+# keeps at most `parallel` of its commands submitted at a time
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _command_pool() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=config.RUN_POOL_WORKERS, thread_name_prefix="ps-run")
+        return _pool
+
+
+def _signal_group(proc: subprocess.Popen, signum: int) -> None:
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signum)
+        else:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _run_shell(script: str, timeout: Optional[float] = None, cwd: Optional[str] = None) -> subprocess.CompletedProcess:
+    """`subprocess.run(shell=True, capture_output=True, text=True)` in its own process group.
+
+    On timeout the whole group is killed, not just the shell, so pipelines and
+    background jobs started by the command do not outlive it.
+    """
+    proc = subprocess.Popen(
+        script,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        cwd=cwd or None,
+        start_new_session=True,
+    )
+    with _running_lock:
+        _running.add(proc)
+    try:
+        try:
+            with tracing.span("command", pid=proc.pid):
+                stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _signal_group(proc, signal.SIGKILL)
+            stdout, stderr = proc.communicate()
+            raise subprocess.TimeoutExpired(script, timeout, output=stdout, stderr=stderr)
+        except BaseException:
+            _signal_group(proc, signal.SIGKILL)
+            proc.wait()
+            raise
+        return subprocess.CompletedProcess(script, proc.returncode, stdout, stderr)
+    finally:
+        with _running_lock:
+            _running.discard(proc)
+
+
+def terminate_all(grace: float = 2.0) -> int:
+    """SIGTERM every running command's process group, then SIGKILL what is left after `grace`.
+
+    Returns how many commands were signalled.
+    """
+    with _running_lock:
+        procs = list(_running)
+    for proc in procs:
+        _signal_group(proc, signal.SIGTERM)
+    deadline = time.monotonic() + grace
+    for proc in procs:
+        try:
+            proc.wait(max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            _signal_group(proc, signal.SIGKILL)
+    return len(procs)
 
 
 def run_command(cmd: str, timeout: Optional[int] = None, cwd: Optional[str] = None) -> Dict:
     start = time.time()
     try:
         # Run in shell for parity with bash usage, return combined results
-        proc = subprocess.run(
-            str(cmd),
-            shell=True,
-            capture_output=True,
-            text=True,
-            timeout=timeout,
-            cwd=cwd or None,
-        )
+        proc = _run_shell(str(cmd), timeout=timeout, cwd=cwd)
         duration = time.time() - start
+        COMMAND_SECONDS.observe(duration, "ok" if proc.returncode == 0 else "error")
         return {
             "ok": proc.returncode == 0,
             "code": proc.returncode,
@@ -29,6 +114,7 @@ def run_command(cmd: str, timeout: Optional[int] = None, cwd: Optional[str] = No
         }
     except subprocess.TimeoutExpired as e:
         duration = time.time() - start
+        COMMAND_SECONDS.observe(duration, "timeout")
         return {
             "ok": False,
             "code": None,
@@ -38,6 +124,7 @@ def run_command(cmd: str, timeout: Optional[int] = None, cwd: Optional[str] = No
         }
     except Exception as e:
         duration = time.time() - start
+        COMMAND_SECONDS.observe(duration, "error")
         return {
             "ok": False,
             "code": None,
@@ -47,11 +134,178 @@ def run_command(cmd: str, timeout: Optional[int] = None, cwd: Optional[str] = No
         }
 
 
-def run_commands(cmds: List[str], timeout: Optional[int] = None, cwd: Optional[str] = None, stop_on_error: bool = False) -> Dict:
-    """Run a list of shell commands sequentially.
+def cancel_command(proc: subprocess.Popen, grace: float = 2.0) -> None:
+    """SIGTERM `proc`'s process group now and SIGKILL it if it is still running after `grace`."""
+    _signal_group(proc, signal.SIGTERM)
+
+    def kill() -> None:
+        if proc.poll() is None:
+            _signal_group(proc, signal.SIGKILL)
+
+    timer = threading.Timer(grace, kill)
+    timer.daemon = True
+    timer.start()
+
+
+def stream_command(
+    cmd: str,
+    timeout: Optional[float] = None,
+    cwd: Optional[str] = None,
+    on_start: Optional[Callable[[subprocess.Popen], None]] = None,
+) -> Iterator[List[Dict]]:
+    """Run `cmd` and yield its output as it is produced.
+
+    Each batch holds the events decoded from one wakeup of the selector:
+    {"event": "stdout"|"stderr", "line": ...} per line, and finally one
+    {"event": "exit", ...} carrying the same fields as run_command (minus the
+    output). A line longer than STREAM_CHUNK_BYTES is split and its pieces are
+    marked "partial", so memory stays bounded whatever the command prints.
+    Closing the generator early (client gone) kills the command's process group;
+    `on_start` receives the process once it is spawned (to cancel it from elsewhere).
+    """
+    start = time.time()
+    try:
+        proc = subprocess.Popen(
+            str(cmd),
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd or None,
+            start_new_session=True,
+        )
+    except Exception as e:
+        COMMAND_SECONDS.observe(time.time() - start, "error")
+        yield [{"event": "exit", "ok": False, "code": None, "error": f"ERROR: {e}", "duration_sec": 0.0}]
+        return
+
+    with _running_lock:
+        _running.add(proc)
+    if on_start is not None:
+        on_start(proc)
+    limit = config.STREAM_CHUNK_BYTES
+    deadline = time.monotonic() + timeout if timeout else None
+    timed_out = False
+    selector = selectors.DefaultSelector()
+    # stream name -> (incremental decoder, text not yet ended by a newline)
+    pending: Dict[str, List] = {}
+    for name, pipe in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+        selector.register(pipe, selectors.EVENT_READ, name)
+        pending[name] = [codecs.getincrementaldecoder("utf-8")("replace"), ""]
+    try:
+        while selector.get_map():
+            wait = None if deadline is None else deadline - time.monotonic()
+            if wait is not None and wait <= 0:
+                timed_out = True
+                _signal_group(proc, signal.SIGKILL)
+                break
+            batch: List[Dict] = []
+            for key, _ in selector.select(wait):
+                name = key.data
+                data = os.read(key.fd, 65536)
+                decoder, text = pending[name]
+                if not data:
+                    selector.unregister(key.fileobj)
+                    text += decoder.decode(b"", final=True)
+                    if text:
+                        batch.append({"event": name, "line": text})
+                    pending[name][1] = ""
+                    continue
+                text += decoder.decode(data)
+                *lines, text = text.split("\n")
+                batch.extend({"event": name, "line": line} for line in lines)
+                while len(text) > limit:
+                    batch.append({"event": name, "line": text[:limit], "partial": True})
+                    text = text[limit:]
+                pending[name][1] = text
+            if batch:
+                yield batch
+        if not timed_out:
+            try:
+                # Both pipes are closed, but the command may have detached from them
+                proc.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                _signal_group(proc, signal.SIGKILL)
+        code = proc.wait()
+        duration = time.time() - start
+        if timed_out:
+            COMMAND_SECONDS.observe(duration, "timeout")
+            exit_event = {"event": "exit", "ok": False, "code": None, "timeout": True}
+        else:
+            COMMAND_SECONDS.observe(duration, "ok" if code == 0 else "error")
+            exit_event = {"event": "exit", "ok": code == 0, "code": code}
+        exit_event["duration_sec"] = round(duration, 4)
+        yield [exit_event]
+    finally:
+        selector.close()
+        if proc.poll() is None:
+            _signal_group(proc, signal.SIGKILL)
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+        with _running_lock:
+            _running.discard(proc)
+
+
+def _cd(c: str, current_cwd: Optional[str]) -> Tuple[Dict, Optional[str]]:
+    """Resolve a `cd` entry against `current_cwd`; returns its result and the new cwd."""
+    start = time.time()
+    dest_arg = c[2:].strip()
+    try:
+        base = Path(current_cwd) if current_cwd else Path.cwd()
+        if not dest_arg:
+            dest = Path(os.path.expanduser("~")).resolve()
+        else:
+            # Expand ~ and environment vars, then resolve relative to base
+            expanded = os.path.expanduser(os.path.expandvars(dest_arg))
+            dest = (Path(expanded) if os.path.isabs(expanded) else (base / expanded)).resolve()
+
+        if not dest.exists() or not dest.is_dir():
+            duration = time.time() - start
+            return {
+                "ok": False,
+                "code": 1,
+                "stdout": "",
+                "stderr": f"cd: no such directory: {dest_arg}",
+                "duration_sec": round(duration, 4),
+            }, current_cwd
+        duration = time.time() - start
+        return {
+            "ok": True,
+            "code": 0,
+            "stdout": str(dest),
+            "stderr": "",
+            "duration_sec": round(duration, 4),
+        }, str(dest)
+    except Exception as e:
+        duration = time.time() - start
+        return {
+            "ok": False,
+            "code": 1,
+            "stdout": "",
+            "stderr": f"cd error: {e}",
+            "duration_sec": round(duration, 4),
+        }, current_cwd
+
+
+def _is_cd(c: str) -> bool:
+    return c == "cd" or c.startswith("cd ")
+
+
+def run_commands(
+    cmds: List[str],
+    timeout: Optional[int] = None,
+    cwd: Optional[str] = None,
+    stop_on_error: bool = False,
+    parallel: int = 1,
+) -> Dict:
+    """Run a list of shell commands sequentially, or up to `parallel` at a time.
 
     Returns an aggregate result with per-command outputs.
     """
+    if parallel > 1:
+        return _run_parallel(cmds, timeout, cwd, stop_on_error, parallel)
     results: List[Dict] = []
     stopped = False
     current_cwd: Optional[str] = cwd or None
@@ -61,46 +315,8 @@ def run_commands(cmds: List[str], timeout: Optional[int] = None, cwd: Optional[s
             continue
 
         # Handle 'cd' internally so directory persists across subsequent commands
-        if c == "cd" or c.startswith("cd "):
-            start = time.time()
-            dest_arg = c[2:].strip()
-            try:
-                base = Path(current_cwd) if current_cwd else Path.cwd()
-                if not dest_arg:
-                    dest = Path(os.path.expanduser("~")).resolve()
-                else:
-                    # Expand ~ and environment vars, then resolve relative to base
-                    expanded = os.path.expanduser(os.path.expandvars(dest_arg))
-                    dest = (Path(expanded) if os.path.isabs(expanded) else (base / expanded)).resolve()
-
-                if not dest.exists() or not dest.is_dir():
-                    duration = time.time() - start
-                    result = {
-                        "ok": False,
-                        "code": 1,
-                        "stdout": "",
-                        "stderr": f"cd: no such directory: {dest_arg}",
-                        "duration_sec": round(duration, 4),
-                    }
-                else:
-                    current_cwd = str(dest)
-                    duration = time.time() - start
-                    result = {
-                        "ok": True,
-                        "code": 0,
-                        "stdout": current_cwd,
-                        "stderr": "",
-                        "duration_sec": round(duration, 4),
-                    }
-            except Exception as e:
-                duration = time.time() - start
-                result = {
-                    "ok": False,
-                    "code": 1,
-                    "stdout": "",
-                    "stderr": f"cd error: {e}",
-                    "duration_sec": round(duration, 4),
-                }
+        if _is_cd(c):
+            result, current_cwd = _cd(c, current_cwd)
         else:
             result = run_command(c, timeout=timeout, cwd=current_cwd)
 
@@ -119,6 +335,253 @@ def run_commands(cmds: List[str], timeout: Optional[int] = None, cwd: Optional[s
     }
 
 
+def _run_parallel(
+    cmds: List[str],
+    timeout: Optional[int],
+    cwd: Optional[str],
+    stop_on_error: bool,
+    parallel: int,
+) -> Dict:
+    """`run_commands` with up to `parallel` commands running at once; results keep input order.
+
+    `cd` entries are resolved up front, so each command gets the directory it would
+    have had sequentially (a `cd` into a directory an earlier command creates fails).
+    With `stop_on_error`, the first failure keeps every command not yet started from
+    starting; those already running finish and are reported.
+    """
+    # Each entry: a finished cd result, or a command with the cwd it runs in
+    plan: List[Tuple[str, Optional[Dict], Optional[str]]] = []
+    stopped = False
+    current_cwd: Optional[str] = cwd or None
+    for raw in cmds:
+        c = str(raw).strip()
+        if not c:
+            continue
+        if _is_cd(c):
+            result, current_cwd = _cd(c, current_cwd)
+            plan.append((c, result, None))
+            if stop_on_error and not result["ok"]:
+                stopped = True
+                break
+        else:
+            plan.append((c, None, current_cwd))
+
+    stop = threading.Event()
+
+    def task(c: str, run_cwd: Optional[str]) -> Optional[Dict]:
+        # Queued behind other requests' commands, this may start after a failure here
+        if stop.is_set():
+            return None
+        result = run_command(c, timeout, run_cwd)
+        if stop_on_error and not result.get("ok"):
+            stop.set()
+        return result
+
+    finished: Dict[int, Optional[Dict]] = {}
+    todo = deque(i for i, (_, result, _) in enumerate(plan) if result is None)
+    running: Dict[Future, int] = {}
+    pool = _command_pool()
+    while todo or running:
+        while todo and len(running) < parallel and not stop.is_set():
+            i = todo.popleft()
+            c, _, run_cwd = plan[i]
+            running[pool.submit(task, c, run_cwd)] = i
+        if not running:
+            break
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            finished[running.pop(future)] = future.result()
+    stopped = stopped or stop.is_set()
+
+    results: List[Dict] = []
+    for i, (c, result, _) in enumerate(plan):
+        if result is None:
+            result = finished.get(i)
+            if result is None:
+                continue
+        results.append({"cmd": c, **result})
+
+    all_ok = all(r.get("ok") for r in results) if results else True
+    return {
+        "ok": all_ok,
+        "stop_on_error": stop_on_error,
+        "stopped": stopped,
+        "parallel": parallel,
+        "results": results,
+    }
+
+
+def _dag_steps(steps) -> Tuple[List[Dict], List[str]]:
+    """Normalize `steps` (a list of {"name", "cmd", "needs"} or a {name: {...}} mapping).
+
+    Returns the steps and their names in a dependency (topological) order.
+
+    Raises ValueError for a malformed step, an unknown dependency or a cycle.
+    """
+    if isinstance(steps, dict):
+        steps = [{"name": name, **(spec if isinstance(spec, dict) else {"cmd": spec})} for name, spec in steps.items()]
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("'steps' must be a non-empty list or object")
+    normalized: List[Dict] = []
+    names: Set[str] = set()
+    for i, step in enumerate(steps):
+        if not isinstance(step, dict):
+            raise ValueError(f"Step {i} is not an object")
+        name = str(step.get("name") or "").strip()
+        cmd = str(step.get("cmd") or step.get("command") or "").strip()
+        needs = step.get("needs") or []
+        if isinstance(needs, str):
+            needs = [needs]
+        if not name or not cmd:
+            raise ValueError(f"Step {i} needs a 'name' and a 'cmd'")
+        if name in names:
+            raise ValueError(f"Duplicate step name {name!r}")
+        if not isinstance(needs, list):
+            raise ValueError(f"Step {name!r}: 'needs' must be a list of step names")
+        names.add(name)
+        normalized.append({"name": name, "cmd": cmd, "needs": [str(n) for n in needs], "cwd": step.get("cwd")})
+    for step in normalized:
+        for need in step["needs"]:
+            if need not in names:
+                raise ValueError(f"Step {step['name']!r} needs unknown step {need!r}")
+
+    # Kahn's algorithm: whatever cannot be ordered sits on a cycle
+    indegree = {step["name"]: len(set(step["needs"])) for step in normalized}
+    dependents: Dict[str, List[str]] = {step["name"]: [] for step in normalized}
+    for step in normalized:
+        for need in set(step["needs"]):
+            dependents[need].append(step["name"])
+    ready = [name for name, n in indegree.items() if n == 0]
+    order: List[str] = []
+    while ready:
+        name = ready.pop()
+        order.append(name)
+        for dep in dependents[name]:
+            indegree[dep] -= 1
+            if indegree[dep] == 0:
+                ready.append(dep)
+    if len(order) < len(normalized):
+        cycle = sorted(name for name, n in indegree.items() if n > 0)
+        raise ValueError(f"Dependency cycle among steps: {', '.join(cycle)}")
+    return normalized, order
+
+
+def run_dag(
+    steps,
+    timeout: Optional[int] = None,
+    cwd: Optional[str] = None,
+    parallel: int = 4,
+    stop_on_error: bool = False,
+) -> Dict:
+    """Run named steps as soon as every step they `need` has succeeded, `parallel` at a time.
+
+    Everything downstream of a failed step is skipped; with `stop_on_error` the
+    first failure also cancels unrelated steps that have not started. A step's
+    own `cwd` is resolved against `cwd` like a `cd` in `run_commands`. Each step
+    reports when it ran (seconds from the start of the graph), and the response
+    names the critical path: the chain of dependencies with the longest wall time.
+    Raises ValueError for an invalid graph.
+    """
+    plan, order = _dag_steps(steps)
+    by_name = {step["name"]: step for step in plan}
+    dependents: Dict[str, List[str]] = {name: [] for name in by_name}
+    for step in plan:
+        for need in set(step["needs"]):
+            dependents[need].append(step["name"])
+    remaining = {step["name"]: len(set(step["needs"])) for step in plan}
+    results: Dict[str, Dict] = {}
+    origin = time.monotonic()
+    stop = threading.Event()
+
+    def run_step(step: Dict) -> Optional[Dict]:
+        # Queued behind other requests' commands, this may start after a failure here
+        if stop.is_set():
+            return None
+        start = time.monotonic() - origin
+        step_cwd = cwd or None
+        result = None
+        if step["cwd"]:
+            result, step_cwd = _cd(f"cd {step['cwd']}", step_cwd)
+        if result is None or result["ok"]:
+            result = run_command(step["cmd"], timeout=timeout, cwd=step_cwd)
+        if stop_on_error and not result["ok"]:
+            stop.set()
+        return {**result, "start_sec": round(start, 4), "end_sec": round(time.monotonic() - origin, 4)}
+
+    def skip(name: str, state: str, reason: str) -> None:
+        # Mark `name` and everything that (transitively) needs it as not run
+        todo = [name]
+        while todo:
+            current = todo.pop()
+            if current in results:
+                continue
+            results[current] = {"state": state, "ok": False, "code": None, "stdout": "", "stderr": reason}
+            todo.extend(dependents[current])
+
+    ready = deque(name for name, n in remaining.items() if n == 0)
+    running: Dict[Future, str] = {}
+    pool = _command_pool()
+    while ready or running:
+        while ready and len(running) < parallel and not stop.is_set():
+            name = ready.popleft()
+            running[pool.submit(run_step, by_name[name])] = name
+        if not running:
+            break
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            result = future.result()
+            if result is None:
+                continue
+            results[name] = {"state": "ok" if result["ok"] else "failed", **result}
+            if not result["ok"]:
+                for dep in dependents[name]:
+                    skip(dep, "skipped", f"skipped: {name} failed")
+                continue
+            for dep in dependents[name]:
+                remaining[dep] -= 1
+                if remaining[dep] == 0 and dep not in results:
+                    ready.append(dep)
+    stopped = stop.is_set()
+    if stopped:
+        # Steps that were running finished; nothing else started
+        for name in by_name:
+            if name not in results:
+                skip(name, "cancelled", "cancelled: an earlier step failed")
+
+    # Critical path over the steps that ran: longest chain of end-to-end wall time
+    finish: Dict[str, float] = {}
+    via: Dict[str, Optional[str]] = {}
+    for name in order:
+        result = results[name]
+        if "end_sec" not in result:
+            continue
+        before = max((n for n in by_name[name]["needs"] if n in finish), key=finish.get, default=None)
+        via[name] = before
+        finish[name] = result["end_sec"] - result["start_sec"] + (finish[before] if before else 0.0)
+
+    last = max(finish, key=finish.get, default=None)
+    critical: List[str] = []
+    while last is not None:
+        critical.append(last)
+        last = via[last]
+    critical.reverse()
+
+    ordered = [
+        {"name": step["name"], "cmd": step["cmd"], "needs": step["needs"], **results[step["name"]]} for step in plan
+    ]
+    return {
+        "ok": all(r["ok"] for r in ordered),
+        "stop_on_error": stop_on_error,
+        "stopped": stopped,
+        "parallel": parallel,
+        "duration_sec": round(time.monotonic() - origin, 4),
+        "critical_path": critical,
+        "critical_path_sec": round(finish[critical[-1]], 4) if critical else 0.0,
+        "steps": ordered,
+    }
+
+
 def run_commands_single_shell(
     cmds: List[str],
     timeout: Optional[int] = None,
@@ -158,14 +621,7 @@ def run_commands_single_shell(
 
     script = "\n".join(lines) + "\n"
 
-    proc = subprocess.run(
-        script,
-        shell=True,
-        capture_output=True,
-        text=True,
-        timeout=timeout,
-        cwd=cwd or None,
-    )
+    proc = _run_shell(script, timeout=timeout, cwd=cwd)
 
     out = proc.stdout or ""
     # Parse segments
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import gzip
+import zlib
+from typing import Iterable, Iterator, Optional
+
+from . import config, tracing
+from .router import Handler, Request, Response, close_body
+
+# Preference order when the client weights encodings equally
+SUPPORTED = ("gzip", "deflate")
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """Pick gzip or deflate from an Accept-Encoding header, honouring q-values."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in SUPPORTED:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def _compress_stream(chunks: Iterable[bytes], encoding: str, level: int) -> Iterator[bytes]:
+    # gzip container for "gzip", zlib container for "deflate" (as HTTP defines it)
+    z = zlib.compressobj(level, zlib.DEFLATED, 31 if encoding == "gzip" else 15)
+    try:
+        for chunk in chunks:
+            # Sync-flush every chunk so the client can decode what has arrived so far
+            out = z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+            if out:
+                yield out
+        yield z.flush()
+    finally:
+        close_body(chunks)
+
+
+def compress(request: Request, call_next: Handler) -> Response:
+    """Middleware: gzip/deflate the response body when the client accepts it.
+
+    Buffered bodies under COMPRESS_MIN_BYTES go out as-is; streamed bodies are
+    always compressed, chunk by chunk.
+    """
+    response = call_next(request)
+    level = config.COMPRESS_LEVEL
+    if level <= 0 or "Content-Encoding" in response.headers:
+        return response
+    encoding = negotiate(request.headers.get("Accept-Encoding") or "")
+    if encoding is None:
+        return response
+
+    if response.stream:
+        response.body = _compress_stream(response.chunks(), encoding, level)
+    else:
+        with tracing.span("serialize"):
+            data = response.encode()
+        # Keep the encoded bytes either way so the engine does not serialize twice
+        if len(data) < config.COMPRESS_MIN_BYTES:
+            response.body = data
+            return response
+        with tracing.span("compress"):
+            if encoding == "gzip":
+                response.body = gzip.compress(data, compresslevel=level, mtime=0)
+            else:
+                response.body = zlib.compress(data, level)
+    response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import math
 import os
 from pathlib import Path
 
@@ -19,5 +20,145 @@ TRANSACTIONS_CSV = TRANSACTIONS_DIR / "transactions.csv"
 SCRAPES_CSV = SCRAPES_DIR / "scrapes.csv"
 WEIGHTS_CSV = WEIGHTS_DIR / "weights.csv"
 
-DEFAULT_HOST = "127.0.0.1"
-DEFAULT_PORT = 9000
+DEFAULT_HOST = os.getenv("PERSONAL_SERVER_HOST", "127.0.0.1")
+DEFAULT_PORT = int(os.getenv("PERSONAL_SERVER_PORT", "9000"))
+
+# Unix domain socket listener, alongside TCP or (PERSONAL_SERVER_TCP=0) instead of it.
+# Mode is octal, e.g. 660 lets the owning group connect.
+_unix_socket = os.getenv("PERSONAL_SERVER_UNIX_SOCKET", "")
+UNIX_SOCKET = Path(_unix_socket) if _unix_socket else None
+UNIX_SOCKET_MODE = int(os.getenv("PERSONAL_SERVER_UNIX_SOCKET_MODE", "660"), 8)
+TCP_ENABLED = os.getenv("PERSONAL_SERVER_TCP", "1") not in ("0", "false", "no", "")
+
+# Server engine: "threaded" (worker pool) or "asyncio" (single event loop)
+DEFAULT_ENGINE = os.getenv("PERSONAL_SERVER_ENGINE", "threaded")
+
+# Prefork: number of server processes sharing the port via SO_REUSEPORT (1 = single process)
+WORKERS = int(os.getenv("PERSONAL_SERVER_WORKERS", "1"))
+
+# HTTP/1.1 persistent connections
+KEEPALIVE_TIMEOUT = float(os.getenv("PERSONAL_SERVER_KEEPALIVE_TIMEOUT", "15"))
+KEEPALIVE_MAX_REQUESTS = int(os.getenv("PERSONAL_SERVER_KEEPALIVE_MAX_REQUESTS", "100"))
+
+# Slow clients: the request line + headers must arrive within HEADER_TIMEOUT in total;
+# each body read and each response write may block for at most BODY/WRITE_TIMEOUT.
+# At most MAX_IDLE_CONNECTIONS keep-alive connections wait idle, the oldest are closed first
+# (0 = no cap). Unset: half of WORKER_THREADS for the threaded engine, 1024 for asyncio.
+HEADER_TIMEOUT = float(os.getenv("PERSONAL_SERVER_HEADER_TIMEOUT", "10"))
+BODY_TIMEOUT = float(os.getenv("PERSONAL_SERVER_BODY_TIMEOUT", "30"))
+WRITE_TIMEOUT = float(os.getenv("PERSONAL_SERVER_WRITE_TIMEOUT", "30"))
+_max_idle = os.getenv("PERSONAL_SERVER_MAX_IDLE_CONNECTIONS")
+MAX_IDLE_CONNECTIONS = int(_max_idle) if _max_idle else None
+
+# Shutdown (SIGINT/SIGTERM): stop accepting, let in-flight requests finish for up to
+# SHUTDOWN_GRACE_SEC, then SIGTERM running commands' process groups (SIGKILL after SHUTDOWN_KILL_GRACE_SEC)
+SHUTDOWN_GRACE_SEC = float(os.getenv("PERSONAL_SERVER_SHUTDOWN_GRACE_SEC", "10"))
+SHUTDOWN_KILL_GRACE_SEC = float(os.getenv("PERSONAL_SERVER_SHUTDOWN_KILL_GRACE_SEC", "2"))
+
+# Threaded engine: fixed worker pool fed by a bounded accept queue (503 when full)
+WORKER_THREADS = int(os.getenv("PERSONAL_SERVER_WORKER_THREADS", "32"))
+ACCEPT_QUEUE_SIZE = int(os.getenv("PERSONAL_SERVER_ACCEPT_QUEUE_SIZE", "128"))
+LISTEN_BACKLOG = int(os.getenv("PERSONAL_SERVER_LISTEN_BACKLOG", "128"))
+RETRY_AFTER_SEC = int(os.getenv("PERSONAL_SERVER_RETRY_AFTER_SEC", "1"))
+
+# Per-route bulkheads: route -> (max concurrent calls, max queued calls).
+# Queued calls wait on the asyncio engine only; the threaded engine answers 503 once a route
+# has `concurrency` calls running, since a waiting call would hold one of its WORKER_THREADS.
+# Override with PERSONAL_SERVER_ROUTE_LIMITS="/run=2:4,/scrape=4:8".
+# Limits hold per process: with --workers N a route may run N x `concurrency` calls in total.
+ROUTE_LIMITS = {
+    "/run": (4, 8),
+    "/scrape": (4, 8),
+    "/notes": (8, 64),
+    "/transactions": (8, 64),
+    "/weights": (8, 64),
+    "/batch": (4, 16),
+    "/sessions": (4, 8),
+    # Job output long-polls (?wait=) hold a thread for up to 30 s each, so keep them to a few
+    "/jobs": (4, 0),
+    # Diagnostics that block for a while (/admin/profile, memory snapshots) run here, off the asyncio loop
+    "/admin": (2, 2),
+}
+for _item in filter(None, os.getenv("PERSONAL_SERVER_ROUTE_LIMITS", "").split(",")):
+    _route, _, _limits = _item.partition("=")
+    _concurrency, _, _queue = _limits.partition(":")
+    ROUTE_LIMITS[_route.strip()] = (int(_concurrency), int(_queue or 0))
+
+# Per-client rate limits: route -> (tokens refilled per second, bucket size), checked
+# before the request body is read. Override with PERSONAL_SERVER_RATE_LIMITS="/run=2:10,/notes=20:40"
+# (a rate of 0 removes the limit). Buckets for at most RATE_LIMIT_MAX_CLIENTS clients are kept per route.
+# Buckets live in each process: with --workers N a client can get up to N x the rate.
+RATE_LIMITS = {
+    "/run": (2.0, 10),
+    "/scrape": (1.0, 5),
+}
+for _item in filter(None, os.getenv("PERSONAL_SERVER_RATE_LIMITS", "").split(",")):
+    _route, _, _limits = _item.partition("=")
+    _rate, _, _burst = _limits.partition(":")
+    RATE_LIMITS[_route.strip()] = (float(_rate), int(_burst or max(1, math.ceil(float(_rate)))))
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("PERSONAL_SERVER_RATE_LIMIT_MAX_CLIENTS", "10000"))
+
+# /run with "parallel": N runs a cmds list N at a time, capped at RUN_MAX_PARALLEL per request
+RUN_MAX_PARALLEL = int(os.getenv("PERSONAL_SERVER_RUN_MAX_PARALLEL", "8"))
+# ...on one pool of RUN_POOL_WORKERS threads shared by all those requests
+RUN_POOL_WORKERS = int(os.getenv("PERSONAL_SERVER_RUN_POOL_WORKERS", "32"))
+
+# /run with "async": true: jobs run on JOB_WORKERS threads; at most JOB_MAX_JOBS are tracked,
+# finished ones are forgotten JOB_TTL_SEC after they end, and each keeps its newest JOB_MAX_OUTPUT_BYTES of output
+JOB_WORKERS = int(os.getenv("PERSONAL_SERVER_JOB_WORKERS", "4"))
+JOB_MAX_JOBS = int(os.getenv("PERSONAL_SERVER_JOB_MAX_JOBS", "1000"))
+JOB_TTL_SEC = float(os.getenv("PERSONAL_SERVER_JOB_TTL_SEC", "3600"))
+JOB_MAX_OUTPUT_BYTES = int(os.getenv("PERSONAL_SERVER_JOB_MAX_OUTPUT_BYTES", str(1024 * 1024)))
+
+# Warm shell sessions (POST /sessions): at most SESSION_MAX shells, closed after
+# SESSION_IDLE_TIMEOUT_SEC without a request
+SESSION_MAX = int(os.getenv("PERSONAL_SERVER_SESSION_MAX", "16"))
+SESSION_IDLE_TIMEOUT_SEC = float(os.getenv("PERSONAL_SERVER_SESSION_IDLE_TIMEOUT_SEC", "600"))
+
+# POST /batch: most operations accepted in one request
+BATCH_MAX_OPERATIONS = int(os.getenv("PERSONAL_SERVER_BATCH_MAX_OPERATIONS", "500"))
+
+# Idempotency-Key replay cache: LRU + TTL, journaled to disk so retries after a
+# restart still get the original response. PERSONAL_SERVER_IDEMPOTENCY_PATH="" keeps it in memory.
+_idempotency = os.getenv("PERSONAL_SERVER_IDEMPOTENCY_PATH", str(DATA_DIR / "idempotency" / "keys.jsonl"))
+IDEMPOTENCY_PATH = Path(_idempotency) if _idempotency else None
+IDEMPOTENCY_MAX_KEYS = int(os.getenv("PERSONAL_SERVER_IDEMPOTENCY_MAX_KEYS", "10000"))
+IDEMPOTENCY_TTL_SEC = float(os.getenv("PERSONAL_SERVER_IDEMPOTENCY_TTL_SEC", str(24 * 3600)))
+
+# Access log: JSON lines written in batches by a background thread.
+# Set PERSONAL_SERVER_ACCESS_LOG="" to disable; errors (5xx) are never sampled out.
+_access_log = os.getenv("PERSONAL_SERVER_ACCESS_LOG", str(DATA_DIR / "logs" / "access.log"))
+ACCESS_LOG_PATH = Path(_access_log) if _access_log else None
+ACCESS_LOG_SAMPLE_RATE = float(os.getenv("PERSONAL_SERVER_ACCESS_LOG_SAMPLE_RATE", "1.0"))
+ACCESS_LOG_MAX_BYTES = int(os.getenv("PERSONAL_SERVER_ACCESS_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+ACCESS_LOG_BACKUPS = int(os.getenv("PERSONAL_SERVER_ACCESS_LOG_BACKUPS", "5"))
+
+# Tracing: every response gets a Server-Timing header (SERVER_TIMING=0 turns it off).
+# Requests slower than SLOW_REQUEST_MS (0 = off) have their span tree logged to SLOW_LOG_PATH.
+SERVER_TIMING = os.getenv("PERSONAL_SERVER_SERVER_TIMING", "1") not in ("0", "false", "no", "")
+SLOW_REQUEST_MS = float(os.getenv("PERSONAL_SERVER_SLOW_REQUEST_MS", "0"))
+SLOW_LOG_PATH = Path(os.getenv("PERSONAL_SERVER_SLOW_LOG", str(DATA_DIR / "logs" / "slow.log")))
+
+# GET /admin/profile: longest run accepted, and the default stack-sampling interval
+PROFILE_MAX_SECONDS = float(os.getenv("PERSONAL_SERVER_PROFILE_MAX_SECONDS", "60"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PERSONAL_SERVER_PROFILE_SAMPLE_INTERVAL_MS", "5"))
+
+# /admin/memory: frames kept per allocation traceback when tracemalloc is started
+# over HTTP, and how many snapshots are kept for diffing (oldest dropped first)
+TRACEMALLOC_FRAMES = int(os.getenv("PERSONAL_SERVER_TRACEMALLOC_FRAMES", "10"))
+MEMORY_MAX_SNAPSHOTS = int(os.getenv("PERSONAL_SERVER_MEMORY_MAX_SNAPSHOTS", "8"))
+
+# Request bodies: larger Content-Length is refused with 413 before reading;
+# NDJSON import routes (/transactions, /weights) stream and get a higher cap.
+MAX_BODY_BYTES = int(os.getenv("PERSONAL_SERVER_MAX_BODY_BYTES", str(1024 * 1024)))
+MAX_IMPORT_BODY_BYTES = int(os.getenv("PERSONAL_SERVER_MAX_IMPORT_BODY_BYTES", str(64 * 1024 * 1024)))
+
+# Streaming responses: /run results bigger than this are sent with chunked
+# transfer encoding and encoded incrementally; chunks are coalesced to ~STREAM_CHUNK_BYTES.
+STREAM_THRESHOLD_BYTES = int(os.getenv("PERSONAL_SERVER_STREAM_THRESHOLD_BYTES", str(256 * 1024)))
+STREAM_CHUNK_BYTES = int(os.getenv("PERSONAL_SERVER_STREAM_CHUNK_BYTES", str(64 * 1024)))
+
+# Response compression (gzip/deflate via Accept-Encoding). Level 0 disables it;
+# buffered bodies smaller than COMPRESS_MIN_BYTES are sent uncompressed.
+COMPRESS_LEVEL = int(os.getenv("PERSONAL_SERVER_COMPRESS_LEVEL", "6"))
+COMPRESS_MIN_BYTES = int(os.getenv("PERSONAL_SERVER_COMPRESS_MIN_BYTES", "1024"))
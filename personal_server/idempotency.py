@@ -0,0 +1,295 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http import HTTPStatus
+from pathlib import Path
+from typing import IO, Any, Dict, Optional
+
+from . import config
+from .router import NDJSON_TYPES, Handler, HTTPError, Request, Response
+from .utils import lock_file, unlock_file
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+# Responses that say "try again" are not worth replaying
+_NOT_STORED = (HTTPStatus.CONFLICT, HTTPStatus.TOO_MANY_REQUESTS)
+
+
+class IdempotencyCache:
+    """Bounded LRU + TTL store of responses keyed by (route, Idempotency-Key).
+
+    Entries are appended to a JSON-lines journal (under an flock, so prefork
+    workers can share it) and replayed on startup; a worker that misses in memory
+    first reads whatever other workers appended since it last looked. The journal
+    is rewritten with only the live entries once it grows past twice the cap.
+
+    A key being processed is claimed with an flock'd file under `pending/` next to
+    the journal, so a retry that lands on another worker gets 409 rather than
+    running the handler a second time.
+    """
+
+    def __init__(self, path: Optional[Path], max_entries: int = 10000, ttl: float = 86400.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.conflicts = 0
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # key -> its claim file (None when there is no journal to share with other processes)
+        self._in_flight: Dict[str, Optional[IO]] = {}
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._inode: Optional[int] = None
+        self._journal_lines = 0
+        self._loaded = False
+
+    def begin(self, key: str, fingerprint: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Return the stored entry for `key`, or claim it for the caller to fill.
+
+        Raises HTTPError 409 while another request holds the key and 422 when the
+        key was first used with a different request body.
+        """
+        with self._lock:
+            if not self._loaded:
+                self._catch_up()
+                self._loaded = True
+            entry = self._get(key)
+            if entry is None:
+                self._catch_up()
+                entry = self._get(key)
+            if entry is None and key not in self._in_flight:
+                claim = self._claim(key)
+                # Another worker may have stored the key between our read and the claim
+                self._catch_up()
+                entry = self._get(key)
+                if entry is None:
+                    self.misses += 1
+                    self._in_flight[key] = claim
+                    return None
+                self._release(claim)
+            if entry is not None:
+                if fingerprint and entry.get("fingerprint") and entry["fingerprint"] != fingerprint:
+                    raise HTTPError(
+                        HTTPStatus.UNPROCESSABLE_ENTITY,
+                        f"{HEADER} was already used with a different request",
+                    )
+                self.hits += 1
+                return entry
+            raise self._in_progress()
+
+    def finish(self, key: str, fingerprint: Optional[str], response: Optional[Response]) -> None:
+        """Release `key`, storing `response` unless it is None (not replayable)."""
+        with self._lock:
+            claim = self._in_flight.pop(key, None)
+            try:
+                if response is None:
+                    return
+                entry = {
+                    "key": key,
+                    "expires": time.time() + self.ttl,
+                    "fingerprint": fingerprint,
+                    "status": int(response.status),
+                    "content_type": response.content_type,
+                    "headers": {k: v for k, v in response.headers.items() if k != "X-Response-Time"},
+                    "body": response.encode().decode("utf-8", "replace"),
+                }
+                self._put(entry)
+                self._append(entry)
+            finally:
+                # Only once the entry is in the journal, so the next claimant replays it
+                self._release(claim)
+
+    def _in_progress(self) -> HTTPError:
+        self.conflicts += 1
+        return HTTPError(
+            HTTPStatus.CONFLICT,
+            f"A request with this {HEADER} is still in progress",
+            {"Retry-After": str(config.RETRY_AFTER_SEC)},
+        )
+
+    def _claim(self, key: str) -> Optional[IO]:
+        """Lock `key` across processes; returns the lock file, raises 409 if another process holds it."""
+        if self.path is None:
+            return None
+        path = self.path.parent / "pending" / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.lock"
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            while True:
+                f = path.open("ab")
+                if not lock_file(f, blocking=False):
+                    f.close()
+                    raise self._in_progress()
+                # A lock taken on a file its previous holder has just unlinked claims nothing
+                try:
+                    if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                        return f
+                except FileNotFoundError:
+                    pass
+                f.close()
+        except OSError:
+            # No shared claim possible (e.g. read-only data dir); this process's own still holds
+            return None
+
+    @staticmethod
+    def _release(claim: Optional[IO]) -> None:
+        if claim is None:
+            return
+        try:
+            # Unlink before unlocking: a waiter that opened this file sees it is stale and retries
+            os.unlink(claim.name)
+        except OSError:
+            pass
+        unlock_file(claim)
+        claim.close()
+
+    def _get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry["expires"] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put(self, entry: Dict[str, Any]) -> None:
+        self._entries[entry["key"]] = entry
+        self._entries.move_to_end(entry["key"])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _catch_up(self) -> None:
+        """Load journal lines written since the last read (by this or another process)."""
+        if self.path is None:
+            return
+        try:
+            with self.path.open("rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self._inode:
+                    # First read, or the journal was compacted: start over
+                    self._inode, self._offset, self._journal_lines = inode, 0, 0
+                f.seek(self._offset)
+                now = time.time()
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # partial write in progress; picked up next time
+                    self._offset += len(line)
+                    self._journal_lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("expires", 0) > now:
+                        self._put(entry)
+        except OSError:
+            return
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        if self.path is None:
+            return
+        data = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            f = self._open_locked()
+            try:
+                f.write(data)
+                f.flush()
+                self._journal_lines += 1
+                if self._journal_lines > 2 * self.max_entries:
+                    self._compact()
+            finally:
+                unlock_file(f)
+                f.close()
+        except OSError:
+            pass
+
+    def _open_locked(self) -> IO:
+        """The journal opened for appending under its flock."""
+        while True:
+            f = self.path.open("ab")
+            lock_file(f)
+            # Compaction may have replaced the file while we waited; appends to the old one would be lost
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            unlock_file(f)
+            f.close()
+
+    def _compact(self) -> None:
+        """Rewrite the journal with only the live entries; the caller holds its flock."""
+        # Pick up what other workers appended first, or the rewrite would drop it
+        self._catch_up()
+        now = time.time()
+        live = [e for e in self._entries.values() if e["expires"] > now]
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with tmp.open("wb") as f:
+            for entry in live:
+                f.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        os.replace(tmp, self.path)
+        self._inode, self._offset, self._journal_lines = None, 0, 0
+        self._catch_up()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "conflicts": self.conflicts,
+            }
+
+
+def _fingerprint(request: Request) -> Optional[str]:
+    # NDJSON imports can be far larger than a JSON body; they are keyed on the header alone
+    if request.content_type in NDJSON_TYPES:
+        return None
+    digest = hashlib.sha256(request.method.encode("latin-1") + b" " + request.path.encode("utf-8") + b"\n")
+    digest.update(request.body())
+    return digest.hexdigest()
+
+
+def idempotent(request: Request, call_next: Handler) -> Response:
+    """Middleware: replay the stored response for a repeated Idempotency-Key.
+
+    The first request with a key runs normally and its response is kept for
+    IDEMPOTENCY_TTL_SEC. Raised errors, 5xx/409/429 and streamed responses are not
+    stored, so retrying those runs the handler again.
+    """
+    key = request.headers.get(HEADER)
+    if not key:
+        return call_next(request)
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{HEADER} longer than {MAX_KEY_LENGTH} characters")
+    scoped = f"{request.route.name if request.route else request.path} {key}"
+    fingerprint = _fingerprint(request)
+    entry = IDEMPOTENCY_CACHE.begin(scoped, fingerprint)
+    if entry is not None:
+        headers = dict(entry["headers"])
+        headers["Idempotent-Replayed"] = "true"
+        return Response(entry["body"], status=entry["status"], headers=headers, content_type=entry["content_type"])
+
+    response: Optional[Response] = None
+    try:
+        response = call_next(request)
+        return response
+    finally:
+        if response is not None and (response.stream or response.status >= 500 or response.status in _NOT_STORED):
+            response = None
+        IDEMPOTENCY_CACHE.finish(scoped, fingerprint, response)
+
+
+IDEMPOTENCY_CACHE = IdempotencyCache(
+    config.IDEMPOTENCY_PATH,
+    max_entries=config.IDEMPOTENCY_MAX_KEYS,
+    ttl=config.IDEMPOTENCY_TTL_SEC,
+)
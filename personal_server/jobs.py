@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from itertools import islice
+from typing import Any, Deque, Dict, List, Optional
+
+from . import config
+from .commands import cancel_command, stream_command
+from .router import HTTPError
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED, TIMEOUT = "queued", "running", "done", "failed", "cancelled", "timeout"
+FINISHED = (DONE, FAILED, CANCELLED, TIMEOUT)
+
+
+class Job:
+    """One background command and the output it has produced so far.
+
+    Output events are the ones `stream_command` yields, numbered from 0. Only the
+    newest `max_output_bytes` worth are kept; `first` is the number of the oldest
+    event still held, so offsets stay valid while a reader tails the job.
+    """
+
+    def __init__(self, cmd: str, timeout: Optional[float], cwd: Optional[str], max_output_bytes: int):
+        self.id = uuid.uuid4().hex
+        self.cmd = cmd
+        self.timeout = timeout
+        self.cwd = cwd
+        self.state = QUEUED
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.exit: Optional[Dict[str, Any]] = None
+        self.max_output_bytes = max_output_bytes
+        self._events: Deque[Dict[str, Any]] = deque()
+        self._bytes = 0
+        self.first = 0
+        self._proc: Optional[subprocess.Popen] = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    @property
+    def next_offset(self) -> int:
+        return self.first + len(self._events)
+
+    def run(self) -> None:
+        with self._lock:
+            if self._cancelled:
+                return
+            self.state = RUNNING
+            self.started = time.time()
+        try:
+            for batch in stream_command(self.cmd, timeout=self.timeout, cwd=self.cwd, on_start=self._spawned):
+                with self._changed:
+                    for event in batch:
+                        if event["event"] == "exit":
+                            self._finish(event)
+                        else:
+                            self._append(event)
+                    self._changed.notify_all()
+        except Exception as e:
+            with self._changed:
+                self._finish({"ok": False, "code": None, "error": f"ERROR: {e}"})
+                self._changed.notify_all()
+
+    def _spawned(self, proc: subprocess.Popen) -> None:
+        with self._lock:
+            self._proc = proc
+            cancelled = self._cancelled
+        if cancelled:
+            cancel_command(proc, config.SHUTDOWN_KILL_GRACE_SEC)
+
+    def _append(self, event: Dict[str, Any]) -> None:
+        self._events.append(event)
+        self._bytes += len(event["line"])
+        while self._bytes > self.max_output_bytes and len(self._events) > 1:
+            self._bytes -= len(self._events.popleft()["line"])
+            self.first += 1
+
+    def _finish(self, event: Dict[str, Any]) -> None:
+        self.exit = {k: v for k, v in event.items() if k != "event"}
+        self.finished = time.time()
+        if self._cancelled:
+            self.state = CANCELLED
+        elif event.get("timeout"):
+            self.state = TIMEOUT
+        else:
+            self.state = DONE if event.get("ok") else FAILED
+        self._proc = None
+
+    def cancel(self) -> None:
+        with self._changed:
+            if self.state in FINISHED:
+                return
+            self._cancelled = True
+            proc = self._proc
+            if self.state == QUEUED:
+                self.state = CANCELLED
+                self.finished = time.time()
+                self._changed.notify_all()
+        if proc is not None:
+            cancel_command(proc, config.SHUTDOWN_KILL_GRACE_SEC)
+
+    def output(self, offset: int, limit: int, wait: float = 0.0) -> Dict[str, Any]:
+        """Events from `offset` on; with `wait`, block up to that long for new ones."""
+        with self._changed:
+            if wait > 0 and offset >= self.next_offset and self.state not in FINISHED:
+                self._changed.wait(wait)
+            start = max(offset, self.first)
+            events = list(islice(self._events, start - self.first, start - self.first + limit))
+            return {
+                "offset": start,
+                "next_offset": start + len(events),
+                "truncated": offset < self.first,
+                "done": self.state in FINISHED and start + len(events) >= self.next_offset,
+                "events": events,
+            }
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "id": self.id,
+                "cmd": self.cmd,
+                "state": self.state,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished,
+                "exit": self.exit,
+                "output_events": self.next_offset,
+            }
+
+
+class JobExecutor:
+    """Runs jobs on a fixed pool and keeps their state for `ttl` seconds after they finish.
+
+    At most `max_jobs` are held; finished jobs past their TTL (then the oldest
+    finished ones) are evicted to make room, and a submit that still finds no
+    room is refused with 503.
+    """
+
+    def __init__(self, workers: int = 4, max_jobs: int = 1000, ttl: float = 3600.0, max_output_bytes: int = 1 << 20):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.max_output_bytes = max_output_bytes
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.submitted = 0
+        self.evicted = 0
+
+    def submit(self, cmd: str, timeout: Optional[float] = None, cwd: Optional[str] = None) -> Job:
+        job = Job(cmd, timeout, cwd, self.max_output_bytes)
+        with self._lock:
+            self._evict(room=True)
+            if len(self._jobs) >= self.max_jobs:
+                raise HTTPError(
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    f"Too many jobs ({self.max_jobs})",
+                    {"Retry-After": str(config.RETRY_AFTER_SEC)},
+                )
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ps-job")
+            self._jobs[job.id] = job
+            self.submitted += 1
+            self._executor.submit(job.run)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        with self._lock:
+            self._evict()
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "Job not found")
+        return job
+
+    def remove(self, job_id: str) -> None:
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _evict(self, room: bool = False) -> None:
+        now = time.time()
+        finished = [j for j in self._jobs.values() if j.state in FINISHED]
+        expired = [j for j in finished if j.finished is not None and now - j.finished > self.ttl]
+        overflow = len(self._jobs) - len(expired) - self.max_jobs + 1
+        if room and overflow > 0:
+            # Still full: make room by dropping the oldest finished jobs as well
+            gone = {j.id for j in expired}
+            expired += [j for j in finished if j.id not in gone][:overflow]
+        for job in expired:
+            del self._jobs[job.id]
+            self.evicted += 1
+
+    def shutdown(self) -> None:
+        """Cancel queued and running jobs; their commands get SIGTERM, then SIGKILL."""
+        with self._lock:
+            jobs: List[Job] = list(self._jobs.values())
+            executor = self._executor
+        for job in jobs:
+            job.cancel()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            counts = {state: 0 for state in (QUEUED, RUNNING, *FINISHED)}
+            for job in self._jobs.values():
+                counts[job.state] += 1
+            return {"jobs": len(self._jobs), "submitted": self.submitted, "evicted": self.evicted, **counts}
+
+
+JOBS = JobExecutor(
+    workers=config.JOB_WORKERS,
+    max_jobs=config.JOB_MAX_JOBS,
+    ttl=config.JOB_TTL_SEC,
+    max_output_bytes=config.JOB_MAX_OUTPUT_BYTES,
+)
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Any, Dict, List, Tuple
+
+from . import config
+from .router import Handler, HTTPError, Request, Response
+
+KEYS = ("lineno", "filename", "traceback")
+
+# Allocations made by tracemalloc itself and by the import machinery are noise here
+_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+class RouteMemory:
+    """Peak traced memory per route while tracemalloc is on.
+
+    tracemalloc keeps a single process-wide peak, so it is only reset when no
+    other tracked request is in flight: each figure is exact for a request that
+    ran alone and an upper bound (it includes the overlapping requests) otherwise.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._active = 0
+        # route -> [requests, total peak bytes, max peak bytes]
+        self._routes: Dict[str, List[int]] = {}
+
+    def begin(self) -> int:
+        with self._lock:
+            if self._active == 0:
+                tracemalloc.reset_peak()
+            self._active += 1
+        return tracemalloc.get_traced_memory()[0]
+
+    def end(self, route: str, base: int) -> None:
+        peak = max(0, tracemalloc.get_traced_memory()[1] - base)
+        with self._lock:
+            self._active -= 1
+            entry = self._routes.setdefault(route, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += peak
+            entry[2] = max(entry[2], peak)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._routes.clear()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {
+                route: {"requests": n, "mean_peak_bytes": total // n, "max_peak_bytes": most}
+                for route, (n, total, most) in sorted(self._routes.items())
+            }
+
+
+class SnapshotStore:
+    """The last `max_snapshots` tracemalloc snapshots, by increasing id."""
+
+    def __init__(self, max_snapshots: int = 8):
+        self.max_snapshots = max_snapshots
+        self._snapshots: "OrderedDict[int, Tuple[float, tracemalloc.Snapshot]]" = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def take(self) -> Tuple[int, tracemalloc.Snapshot]:
+        if not tracemalloc.is_tracing():
+            raise HTTPError(HTTPStatus.CONFLICT, "tracemalloc is not running; POST /admin/memory/start first")
+        snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+        with self._lock:
+            snapshot_id = self._next_id
+            self._next_id += 1
+            self._snapshots[snapshot_id] = (time.time(), snapshot)
+            while len(self._snapshots) > self.max_snapshots:
+                self._snapshots.popitem(last=False)
+        return snapshot_id, snapshot
+
+    def get(self, snapshot_id: int) -> tracemalloc.Snapshot:
+        with self._lock:
+            entry = self._snapshots.get(snapshot_id)
+        if entry is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"No snapshot {snapshot_id}")
+        return entry[1]
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {"id": snapshot_id, "ts": ts, "traces": len(snapshot.traces)}
+                for snapshot_id, (ts, snapshot) in self._snapshots.items()
+            ]
+
+
+def start(frames: int) -> None:
+    if tracemalloc.is_tracing():
+        return
+    ROUTE_MEMORY.reset()
+    tracemalloc.start(frames)
+
+
+def stop() -> None:
+    # Snapshots stay readable; per-route figures would be meaningless once tracing restarts
+    tracemalloc.stop()
+
+
+def status() -> Dict[str, Any]:
+    tracing = tracemalloc.is_tracing()
+    current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+    return {
+        "tracing": tracing,
+        "frames": tracemalloc.get_traceback_limit() if tracing else 0,
+        "current_bytes": current,
+        "peak_bytes": peak,
+        "overhead_bytes": tracemalloc.get_tracemalloc_memory() if tracing else 0,
+        "snapshots": SNAPSHOTS.list(),
+        "routes": ROUTE_MEMORY.stats(),
+    }
+
+
+def _site(traceback: tracemalloc.Traceback, key: str) -> Any:
+    if key == "filename":
+        return traceback[0].filename
+    if key == "traceback":
+        # Outermost call first, like a Python traceback
+        return [f"{frame.filename}:{frame.lineno}" for frame in reversed(traceback)]
+    return f"{traceback[0].filename}:{traceback[0].lineno}"
+
+
+def top(snapshot: tracemalloc.Snapshot, key: str = "lineno", limit: int = 20) -> Dict[str, Any]:
+    """Largest allocation sites in `snapshot`, grouped by `key`."""
+    stats = snapshot.statistics(key)
+    return {
+        "total_bytes": sum(s.size for s in stats),
+        "sites": [{"site": _site(s.traceback, key), "bytes": s.size, "count": s.count} for s in stats[:limit]],
+    }
+
+
+def diff(old: tracemalloc.Snapshot, new: tracemalloc.Snapshot, key: str = "lineno", limit: int = 20) -> Dict[str, Any]:
+    """Allocation sites that changed most between two snapshots."""
+    stats = new.compare_to(old, key)
+    return {
+        "total_bytes_diff": sum(s.size_diff for s in stats),
+        "sites": [
+            {
+                "site": _site(s.traceback, key),
+                "bytes": s.size,
+                "bytes_diff": s.size_diff,
+                "count": s.count,
+                "count_diff": s.count_diff,
+            }
+            for s in stats[:limit]
+        ],
+    }
+
+
+def memory_tracked(request: Request, call_next: Handler) -> Response:
+    """Middleware: record each route's peak allocation while tracemalloc is on."""
+    if not tracemalloc.is_tracing():
+        return call_next(request)
+    base = ROUTE_MEMORY.begin()
+    try:
+        return call_next(request)
+    finally:
+        ROUTE_MEMORY.end(request.route.name if request.route else "unmatched", base)
+
+
+ROUTE_MEMORY = RouteMemory()
+SNAPSHOTS = SnapshotStore(config.MEMORY_MAX_SNAPSHOTS)
@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COMMAND_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+Labels = Tuple[str, ...]
+
+
+class _Metric:
+    """Base for metrics recorded into per-thread shards.
+
+    Each thread writes only to its own dict, so the hot path takes no lock; the
+    lock is touched once per thread (to register its shard) and on scrape. Shards
+    of threads that have exited are folded into `_base` on scrape and dropped, so
+    short-lived threads do not pile up.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Dict[Labels, object]]] = []
+        self._base: Dict[Labels, object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _shard(self) -> Dict[Labels, object]:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _merge(self, into: Dict[Labels, object], shard: Dict[Labels, object]) -> None:
+        raise NotImplementedError
+
+    def _snapshots(self) -> List[Dict[Labels, object]]:
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # Nothing writes to it any more
+                    self._merge(self._base, shard)
+            self._shards = live
+            shards = [self._base, *(shard for _, shard in live)]
+        # dict.copy() runs under the GIL, so a concurrent writer cannot tear it
+        return [s.copy() for s in shards]
+
+    def _labels(self, values: Labels, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, into: Dict[Labels, float], shard: Dict[Labels, float]) -> None:
+        for key, value in shard.items():
+            into[key] = into.get(key, 0) + value
+
+    def collect(self) -> Dict[Labels, float]:
+        total: Dict[Labels, float] = {}
+        for shard in self._snapshots():
+            self._merge(total, shard)
+        return total
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{self._labels(k)} {_num(v)}" for k, v in sorted(self.collect().items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        # Layout: one slot per bucket, one for +Inf, then the running sum
+        rec = shard.get(labels)
+        if rec is None:
+            rec = [0] * (len(self.buckets) + 2)
+            shard[labels] = rec
+        rec[bisect_left(self.buckets, value)] += 1
+        rec[-1] += value
+
+    def _merge(self, into: Dict[Labels, List[float]], shard: Dict[Labels, List[float]]) -> None:
+        for key, rec in shard.items():
+            # A new list, so a scrape still reading the old one never sees it change
+            acc = into.get(key) or [0] * len(rec)
+            into[key] = [a + v for a, v in zip(acc, list(rec))]
+
+    def collect(self) -> Dict[Labels, List[float]]:
+        total: Dict[Labels, List[float]] = {}
+        for shard in self._snapshots():
+            self._merge(total, shard)
+        return total
+
+    def render(self) -> List[str]:
+        lines: List[str] = []
+        for key, rec in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, rec):
+                cumulative += count
+                le = self._labels(key, 'le="%s"' % _num(bound))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            cumulative += rec[len(self.buckets)]
+            le = self._labels(key, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_num(rec[-1])}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _num(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render() -> str:
+    """Prometheus text exposition format (version 0.0.4) for every registered metric."""
+    out: List[str] = []
+    for metric in REGISTRY:
+        out.append(f"# HELP {metric.name} {metric.help}")
+        out.append(f"# TYPE {metric.name} {metric.kind}")
+        out.extend(metric.render())
+    return "\n".join(out) + "\n"
+
+
+REQUESTS = Counter(
+    "personal_server_requests_total",
+    "HTTP requests by route, method and status code.",
+    ("route", "method", "status"),
+)
+REQUEST_SECONDS = Histogram(
+    "personal_server_request_duration_seconds",
+    "HTTP request latency from dispatch to response written.",
+    ("route", "method"),
+)
+COMMAND_SECONDS = Histogram(
+    "personal_server_command_duration_seconds",
+    "Wall time of subprocesses started by run_command.",
+    ("outcome",),
+    buckets=COMMAND_BUCKETS,
+)
+SCRAPE_SECONDS = Histogram(
+    "personal_server_scrape_fetch_duration_seconds",
+    "Wall time of fetch_url, including DNS, connect and body download.",
+    ("outcome",),
+)
+SCRAPE_BYTES = Histogram(
+    "personal_server_scrape_fetch_bytes",
+    "Response body size downloaded by fetch_url.",
+    buckets=BYTES_BUCKETS,
+)
+CSV_APPEND_SECONDS = Histogram(
+    "personal_server_csv_append_duration_seconds",
+    "Latency of append_csv_row by CSV file.",
+    ("file",),
+)
+CONNECTIONS_REAPED = Counter(
+    "personal_server_connections_reaped_total",
+    "Connections closed by the server for being idle or stalled, by reason.",
+    ("reason",),
+)
+
+
+def observe_request(route: str, method: str, status: int, seconds: float) -> None:
+    REQUESTS.inc(route, method, str(int(status)))
+    REQUEST_SECONDS.observe(seconds, route, method)
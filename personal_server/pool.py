@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from http.server import HTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from . import config
+from .metrics import CONNECTIONS_REAPED
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer with a fixed set of worker threads fed by a bounded accept queue.
+
+    Accepted connections wait in the queue until a worker is free; once the queue
+    is full new connections get an immediate 503 with Retry-After instead of a thread.
+    A reaper thread enforces whole-phase deadlines that per-recv socket timeouts
+    cannot (a client trickling one header byte at a time never trips those).
+    """
+
+    daemon_threads = True
+    request_queue_size = config.LISTEN_BACKLOG
+
+    def __init__(
+        self,
+        server_address,
+        RequestHandlerClass,
+        workers: int = config.WORKER_THREADS,
+        queue_size: int = config.ACCEPT_QUEUE_SIZE,
+        reuse_port: bool = False,
+        sock: Optional[socket.socket] = None,
+    ):
+        self.reuse_port = reuse_port
+        if sock is None:
+            super().__init__(server_address, RequestHandlerClass)
+        else:
+            # Already bound and listening (a Unix socket, possibly shared by prefork workers)
+            self.address_family = sock.family
+            super().__init__(server_address, RequestHandlerClass, bind_and_activate=False)
+            self.socket.close()
+            self.socket = sock
+            self.server_name, self.server_port = "localhost", 0
+        self.workers = workers
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.draining = False
+        # Idle keep-alive connections each pin a worker thread; keep half the pool for new ones
+        self.max_idle = workers // 2 if config.MAX_IDLE_CONNECTIONS is None else config.MAX_IDLE_CONNECTIONS
+        # conn -> (deadline, phase, phase start); insertion-ordered, so the first "idle" entry is the oldest
+        self._deadlines: Dict[socket.socket, Tuple[float, str, float]] = {}
+        self._threads: List[threading.Thread] = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"ps-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        threading.Thread(target=self._reap_stalled, name="ps-reaper", daemon=True).start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            # Prefork workers each bind the same port; the kernel balances accepts
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            self._reject(request)
+            return
+        with self._lock:
+            self.accepted += 1
+
+    def _worker(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self._lock:
+                self.active += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._lock:
+                    self.active -= 1
+                    self._deadlines.pop(request, None)
+                self._queue.task_done()
+
+    def _reject(self, request: socket.socket) -> None:
+        data = json.dumps({"ok": False, "error": "Server busy"}).encode("utf-8")
+        head = (
+            "HTTP/1.1 503 Service Unavailable\r\n"
+            "Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Retry-After: {config.RETRY_AFTER_SEC}\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1")
+        try:
+            request.settimeout(0.5)
+            request.sendall(head + data)
+            # Swallow whatever part of the request already arrived so close() does not send RST
+            request.setblocking(False)
+            request.recv(65536)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+    @property
+    def saturated(self) -> bool:
+        return self._queue.qsize() > 0
+
+    def watch(self, conn: socket.socket, phase: str, seconds: float) -> None:
+        """Close `conn` unless the current phase ("idle", "header") ends within `seconds`."""
+        with self._lock:
+            self._deadlines.pop(conn, None)
+            now = time.monotonic()
+            self._deadlines[conn] = (now + seconds, phase, now)
+        if phase == "idle" and self.draining:
+            self._close_idle()
+
+    def unwatch(self, conn: socket.socket) -> bool:
+        """Stop the deadline; False if the connection was already reaped."""
+        with self._lock:
+            return self._deadlines.pop(conn, None) is not None
+
+    def _close(self, conn: socket.socket) -> None:
+        with self._lock:
+            self._deadlines.pop(conn, None)
+        try:
+            # The worker's pending read sees EOF and ends the connection
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _close_idle(self) -> None:
+        with self._lock:
+            idle = [c for c, (_, p, _) in self._deadlines.items() if p == "idle"]
+        for conn in idle:
+            self._close(conn)
+
+    def _reap_stalled(self, interval: float = 0.25) -> None:
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            with self._lock:
+                expired = [(c, p) for c, (deadline, p, _) in self._deadlines.items() if deadline <= now]
+                # Over the idle cap: the longest-idle connections give their workers back. Ones that
+                # went idle moments ago are left alone, their client is likely sending the next request.
+                idle = [c for c, (_, p, since) in self._deadlines.items() if p == "idle" and now - since >= interval]
+                excess = len(idle) - self.max_idle if self.max_idle else 0
+            for conn, phase in expired:
+                CONNECTIONS_REAPED.inc(f"{phase}_timeout")
+                self._close(conn)
+            for conn in idle[: max(0, excess)]:
+                CONNECTIONS_REAPED.inc("idle_limit")
+                self._close(conn)
+
+    def drain(self, timeout: float) -> bool:
+        """Stop accepting and wait for queued and in-flight requests to finish.
+
+        Idle keep-alive connections are closed; busy ones answer with
+        `Connection: close`. Returns False if work was still running at the deadline.
+        """
+        self.draining = True
+        self.socket.close()
+        deadline = time.monotonic() + timeout
+        while True:
+            self._close_idle()
+            # Counts connections from the moment they are queued until a worker is done with them
+            if self._queue.unfinished_tasks == 0:
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "engine": "threaded",
+                "pid": os.getpid(),
+                "workers": self.workers,
+                "active_workers": self.active,
+                "queue_depth": self._queue.qsize(),
+                "queue_size": self._queue.maxsize,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "draining": self.draining,
+                "idle_connections": sum(1 for _, p, _ in self._deadlines.values() if p == "idle"),
+            }
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._threads:
+            # Sentinels go in even if the queue is full; workers drain it first
+            self._queue.put(None)
+        for t in self._threads:
+            t.join(timeout=1)
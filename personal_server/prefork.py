@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import os
+import signal
+import sys
+import time
+from typing import Callable, Dict
+
+
+class Supervisor:
+    """Prefork process manager: N copies of `serve` listening on one port.
+
+    Each worker binds the port itself with SO_REUSEPORT, so the kernel spreads
+    new connections across processes and every worker has its own GIL. Workers
+    that exit unexpectedly are restarted; SIGTERM/SIGINT are forwarded as SIGINT,
+    which runs the single-process shutdown path in each worker.
+    """
+
+    def __init__(self, workers: int, serve: Callable[[], None], grace: float = 10.0, min_uptime: float = 1.0):
+        self.workers = workers
+        self.serve = serve
+        self.grace = grace
+        self.min_uptime = min_uptime
+        self.children: Dict[int, int] = {}  # pid -> slot
+        self.started: Dict[int, float] = {}  # slot -> start time
+        self.restarts = 0
+        self.stopping = False
+
+    def _spawn(self, slot: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            # Own process group, so a terminal Ctrl-C reaches workers only through the supervisor
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                self.serve()
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                import traceback
+
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.children[pid] = slot
+        self.started[slot] = time.monotonic()
+
+    def _on_signal(self, signum, frame) -> None:
+        self.stopping = True
+        self._signal_children(signal.SIGINT)
+
+    def _signal_children(self, signum: int) -> None:
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        for slot in range(self.workers):
+            self._spawn(slot)
+        while not self.stopping:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            slot = self.children.pop(pid, None)
+            if slot is None or self.stopping:
+                continue
+            self.restarts += 1
+            print(
+                f"worker {pid} (slot {slot}) exited with status {os.waitstatus_to_exitcode(status)}; restarting",
+                file=sys.stderr,
+            )
+            # Back off when a worker dies straight after starting (e.g. the port cannot be bound)
+            if time.monotonic() - self.started[slot] < self.min_uptime:
+                time.sleep(self.min_uptime)
+            if not self.stopping:
+                self._spawn(slot)
+        self._reap()
+
+    def _reap(self) -> None:
+        deadline = time.monotonic() + self.grace
+        while self.children and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                break
+            if pid:
+                self.children.pop(pid, None)
+            else:
+                time.sleep(0.05)
+        if self.children:
+            self._signal_children(signal.SIGKILL)
+            for pid in list(self.children):
+                os.waitpid(pid, 0)
+            self.children.clear()
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from http import HTTPStatus
+from types import FrameType
+from typing import Dict, Optional, Set
+
+from .router import Handler, HTTPError, Request, Response
+
+MODES = ("sample", "cprofile")
+
+# Modules whose frames sit on top of a blocked thread (locks, conditions, queues, selectors)
+_WAIT_MODULES = {"threading.py", "queue.py", "selectors.py", "socket.py"}
+
+# Loops that park a thread until there is work. A thread whose innermost frame outside
+# _WAIT_MODULES is one of these is idle and dropped from samples unless idle=1; a request
+# blocked on a lock or a pipe is not (its own frames sit in between).
+_IDLE_LOOPS = {
+    ("thread.py", "_worker"),  # concurrent.futures pools (bulkheads, jobs, command pool)
+    ("pool.py", "_worker"),
+    ("pool.py", "_reap_stalled"),  # time.sleep has no Python frame of its own
+    ("socketserver.py", "serve_forever"),
+    ("base_events.py", "_run_once"),
+    ("accesslog.py", "_run"),
+    ("sessions.py", "_reap_idle"),
+}
+
+
+class ProfileSession:
+    """One profiling run, active for a fixed number of seconds.
+
+    "sample" mode polls every thread's stack with sys._current_frames() and
+    counts collapsed stacks; "cprofile" mode runs cProfile around each request
+    (the `profiled` middleware) and merges the results. With `header` set, only
+    requests carrying that header are sampled or profiled.
+    """
+
+    def __init__(self, mode: str, header: Optional[str] = None, interval: float = 0.005, idle: bool = False):
+        self.mode = mode
+        self.header = header
+        self.interval = interval
+        self.idle = idle
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self.stats: Optional[pstats.Stats] = None
+        self.requests = 0
+        self.skipped = 0
+        # Threads currently serving a request that matches `header`
+        self._marked: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def wants(self, request: Request) -> bool:
+        return self.header is None or request.headers.get(self.header) is not None
+
+    def run(self, seconds: float) -> None:
+        """Block for `seconds`, sampling stacks on this thread in "sample" mode."""
+        deadline = time.monotonic() + seconds
+        if self.mode != "sample":
+            time.sleep(seconds)
+            return
+        me = threading.get_ident()
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            self._sample(me)
+            time.sleep(min(self.interval, deadline - now))
+
+    def _sample(self, me: int) -> None:
+        frames = sys._current_frames()
+        with self._lock:
+            marked = set(self._marked) if self.header is not None else None
+        self.sample_count += 1
+        for ident, frame in frames.items():
+            if ident == me or (marked is not None and ident not in marked):
+                continue
+            if not self.idle and _is_idle(frame):
+                continue
+            self.samples[_collapse(frame)] += 1
+
+    def mark(self, ident: int) -> None:
+        with self._lock:
+            self._marked.add(ident)
+
+    def unmark(self, ident: int) -> None:
+        with self._lock:
+            self._marked.discard(ident)
+
+    def skip(self) -> None:
+        with self._lock:
+            self.skipped += 1
+
+    def add(self, profile: cProfile.Profile) -> None:
+        with self._lock:
+            self.requests += 1
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def collapsed(self) -> str:
+        """Brendan Gregg's folded format: `outer;...;inner count`, one stack per line."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def report(self, sort: str = "cumulative", limit: int = 50) -> str:
+        out = io.StringIO()
+        out.write(f"{self.requests} request(s) profiled, {self.skipped} skipped\n")
+        if self.stats is not None:
+            self.stats.stream = out
+            self.stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def raw(self) -> bytes:
+        """Stats in the file format of pstats.dump_stats (for snakeviz, gprof2dot, ...)."""
+        if self.stats is None:
+            return marshal.dumps({})
+        return marshal.dumps(self.stats.stats)
+
+
+def _is_idle(frame: Optional[FrameType]) -> bool:
+    while frame is not None and os.path.basename(frame.f_code.co_filename) in _WAIT_MODULES:
+        frame = frame.f_back
+    if frame is None:
+        # Nothing but waiting, e.g. a bare threading.Timer
+        return True
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in _IDLE_LOOPS
+
+
+def _collapse(frame: Optional[FrameType]) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+_session: Optional[ProfileSession] = None
+_session_lock = threading.Lock()
+
+
+def profile_for(seconds: float, session: ProfileSession) -> ProfileSession:
+    """Run `session` for `seconds`; one session per process at a time (HTTPError 409 otherwise)."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            raise HTTPError(HTTPStatus.CONFLICT, "A profiling session is already running")
+        _session = session
+    try:
+        session.run(seconds)
+    finally:
+        with _session_lock:
+            _session = None
+    return session
+
+
+def profiled(request: Request, call_next: Handler) -> Response:
+    """Middleware: feed requests to the active profiling session, if any."""
+    session = _session
+    if session is None or not session.wants(request):
+        return call_next(request)
+    ident = threading.get_ident()
+    if session.mode == "sample":
+        session.mark(ident)
+        try:
+            return call_next(request)
+        finally:
+            session.unmark(ident)
+
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Only one cProfile may be active per interpreter on newer Pythons; skip this one
+        session.skip()
+        return call_next(request)
+    try:
+        return call_next(request)
+    finally:
+        profile.disable()
+        session.add(profile)
+
+
+def thread_dump() -> str:
+    """Current stack of every thread, innermost call last."""
+    names: Dict[int, threading.Thread] = {t.ident: t for t in threading.enumerate() if t.ident is not None}
+    out = io.StringIO()
+    for ident, frame in sys._current_frames().items():
+        thread = names.get(ident)
+        name = thread.name if thread else "<unknown>"
+        daemon = " daemon" if thread is not None and thread.daemon else ""
+        out.write(f'Thread {ident} "{name}"{daemon}\n')
+        out.write("".join(traceback.format_stack(frame)))
+        out.write("\n")
+    return out.getvalue()
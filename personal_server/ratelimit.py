@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from . import config
+
+
+class RateLimited(Exception):
+    """Raised when a client has no tokens left for a route."""
+
+    def __init__(self, limit: "RateLimit", retry_after: float):
+        super().__init__(limit.name)
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+class RateLimit:
+    """Per-client token buckets for one route.
+
+    Each client gets `burst` tokens refilled at `rate` per second; a request
+    takes one. Buckets live in an LRU capped at `max_clients`, so memory stays
+    bounded however many addresses show up: an evicted client simply starts over
+    with a full bucket, which is also what it would have after going quiet.
+    Buckets are per process; prefork workers each keep their own.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, max_clients: int = 10000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client -> [tokens, last refill time]
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def take(self, client: str) -> Dict[str, str]:
+        """Spend one of `client`'s tokens and return the quota headers.
+
+        Raises RateLimited when the bucket is empty.
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = [float(self.burst), now]
+                self._buckets[client] = bucket
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+                bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < 1.0:
+                self.limited += 1
+                raise RateLimited(self, (1.0 - bucket[0]) / self.rate)
+            bucket[0] -= 1.0
+            self.allowed += 1
+            tokens = bucket[0]
+        return self.headers(tokens)
+
+    def headers(self, tokens: float) -> Dict[str, str]:
+        # Seconds until the bucket is full again
+        reset = (self.burst - tokens) / self.rate
+        return {
+            "X-RateLimit-Limit": str(self.burst),
+            "X-RateLimit-Remaining": str(int(tokens)),
+            "X-RateLimit-Reset": str(math.ceil(reset)),
+        }
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "burst": self.burst,
+                "clients": len(self._buckets),
+                "allowed": self.allowed,
+                "limited": self.limited,
+            }
+
+
+_limits: Dict[str, RateLimit] = {
+    route: RateLimit(route, rate, burst, config.RATE_LIMIT_MAX_CLIENTS)
+    for route, (rate, burst) in config.RATE_LIMITS.items()
+    if rate > 0
+}
+
+
+def get_rate_limit(path: str) -> Optional[RateLimit]:
+    """Return the rate limit for `path` (matched on its first segment), if any."""
+    route = "/" + path.lstrip("/").split("/", 1)[0].split("?", 1)[0]
+    return _limits.get(route)
+
+
+def all_stats() -> Dict[str, Dict[str, float]]:
+    return {route: limit.stats() for route, limit in _limits.items()}
@@ -0,0 +1,509 @@
+from __future__ import annotations
+
+import io
+import json
+import math
+import time
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from . import config, tracing
+from .accesslog import SLOW_LOG
+from .bodies import BodyError, BodyReader, body_framing
+from .bulkhead import Bulkhead, BulkheadFull
+from .ratelimit import RateLimit, RateLimited
+
+
+class HTTPError(Exception):
+    """Raised by handlers and middleware to answer with an error payload."""
+
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+NDJSON_CONTENT_TYPE = "application/x-ndjson; charset=utf-8"
+# Request Content-Types read as one JSON record per line
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+_encoder = json.JSONEncoder(ensure_ascii=False)
+
+
+@dataclass
+class Response:
+    """Handler result.
+
+    With `stream=True` the engines send the body with chunked transfer encoding:
+    a dict/list body is encoded incrementally (`iterencode`), any other body is
+    an iterable of str/bytes pieces produced while the response is being sent.
+    Pieces are coalesced to `chunk_size` bytes before each write; 1 sends every
+    piece as soon as it is produced.
+    """
+
+    body: Any
+    status: int = HTTPStatus.OK
+    headers: Dict[str, str] = field(default_factory=dict)
+    content_type: str = JSON_CONTENT_TYPE
+    stream: bool = False
+    chunk_size: int = config.STREAM_CHUNK_BYTES
+
+    @classmethod
+    def ndjson(cls, items: Iterable[Any], **kwargs: Any) -> "Response":
+        lines = (_encoder.encode(item) + "\n" for item in items)
+        return cls(lines, content_type=NDJSON_CONTENT_TYPE, stream=True, **kwargs)
+
+    def encode(self) -> bytes:
+        if isinstance(self.body, bytes):
+            return self.body
+        if isinstance(self.body, str):
+            return self.body.encode("utf-8")
+        return _encoder.encode(self.body).encode("utf-8")
+
+    def chunks(self, size: Optional[int] = None) -> Iterator[bytes]:
+        """Body pieces coalesced to roughly `size` (default `chunk_size`) bytes, for streaming."""
+        if isinstance(self.body, (dict, list)):
+            pieces: Iterable[Any] = _encoder.iterencode(self.body)
+        elif isinstance(self.body, (str, bytes)):
+            pieces = (self.body,)
+        else:
+            pieces = self.body
+        # Bind the current body now; middleware may replace self.body with a wrapper around this
+        return _coalesce(pieces, size or self.chunk_size)
+
+
+def _coalesce(pieces: Iterable[Any], size: int) -> Iterator[bytes]:
+    buf: List[bytes] = []
+    buffered = 0
+    try:
+        for piece in pieces:
+            data = piece.encode("utf-8") if isinstance(piece, str) else piece
+            buf.append(data)
+            buffered += len(data)
+            if buffered >= size:
+                yield b"".join(buf)
+                buf, buffered = [], 0
+        if buffered:
+            yield b"".join(buf)
+    finally:
+        close_body(pieces)
+
+
+def close_body(body: Any) -> None:
+    """Close a streamed body's iterator so whatever feeds it (files, subprocesses) is released now."""
+    close = getattr(body, "close", None)
+    if close is not None:
+        close()
+
+
+class Request:
+    """Engine-neutral view of one HTTP request.
+
+    The body stays on the wire until a handler asks for it through `stream()`,
+    `body()`, `json()` or `ndjson()`, so routing and middleware run first and the
+    route's `max_body` limit applies before anything is read.
+    """
+
+    def __init__(
+        self,
+        method: str,
+        target: str,
+        headers: Mapping[str, str],
+        rfile: Optional[BinaryIO] = None,
+        client: str = "",
+        server: Any = None,
+    ):
+        parts = urlsplit(target)
+        self.method = method
+        self.target = target
+        self.path = unquote(parts.path) or "/"
+        self.query: Dict[str, List[str]] = parse_qs(parts.query, keep_blank_values=True)
+        self.params: Dict[str, Any] = {}
+        self.route: Optional["Route"] = None
+        self.headers = headers
+        self.client = client
+        self.server = server
+        self.rfile = rfile
+        self._reader: Optional[BodyReader] = None
+        self._raw: Optional[bytes] = None
+        self._json: Any = None
+
+    def arg(self, name: str, default: Any = None, type: Callable[[str], Any] = str) -> Any:
+        values = self.query.get(name)
+        if not values:
+            return default
+        try:
+            return type(values[-1])
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid query parameter {name!r}")
+
+    @property
+    def content_type(self) -> str:
+        return (self.headers.get("Content-Type") or "").split(";", 1)[0].strip().lower()
+
+    @property
+    def max_body(self) -> int:
+        return self.route.max_body if self.route else config.MAX_BODY_BYTES
+
+    @property
+    def bytes_read(self) -> int:
+        return self._reader.consumed if self._reader else 0
+
+    def stream(self) -> BodyReader:
+        """Incremental reader over the body (Content-Length or chunked), capped at `max_body`."""
+        if self._reader is None:
+            try:
+                length, chunked = body_framing(self.headers)
+                self._reader = BodyReader(self.rfile or io.BytesIO(), length, chunked, self.max_body)
+            except BodyError as e:
+                raise HTTPError(e.status, e.message)
+        return self._reader
+
+    def body(self) -> bytes:
+        if self._raw is None:
+            try:
+                self._raw = self.stream().read()
+            except BodyError as e:
+                raise HTTPError(e.status, e.message)
+        return self._raw
+
+    def json(self) -> Dict[str, Any]:
+        """The body as a JSON object; any other JSON value is a 400."""
+        value = self.json_value()
+        if not isinstance(value, dict):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected a JSON object")
+        return value
+
+    def json_value(self) -> Any:
+        """The body as any JSON value (object, array, ...), for handlers that accept more than objects."""
+        if self._json is None:
+            with tracing.span("parse"):
+                raw = self.body()
+                try:
+                    self._json = parse_body(raw)
+                except Exception as e:
+                    raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid JSON: {e}")
+        return self._json
+
+    def ndjson(self) -> Iterator[Dict[str, Any]]:
+        """Yield one decoded JSON object per body line without buffering the whole body."""
+        lineno = 0
+        try:
+            for line in self.stream():
+                lineno += 1
+                if not line.strip():
+                    continue
+                try:
+                    obj = json.loads(line)
+                except ValueError as e:
+                    raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid JSON on line {lineno}: {e}")
+                if not isinstance(obj, dict):
+                    raise HTTPError(HTTPStatus.BAD_REQUEST, f"Line {lineno} is not a JSON object")
+                yield obj
+        except BodyError as e:
+            raise HTTPError(e.status, e.message)
+
+    def discard_body(self, max_bytes: int = 65536) -> bool:
+        """Skip any unread body; False means the connection cannot be reused."""
+        try:
+            return self.stream().discard(max_bytes)
+        except HTTPError:
+            return False
+
+
+Handler = Callable[[Request], Response]
+# Middleware wraps a handler: middleware(request, call_next) -> Response
+Middleware = Callable[[Request, Handler], Response]
+
+
+CONVERTERS: Dict[str, Callable[[str], Any]] = {"str": str, "int": int, "float": float}
+
+
+class Route:
+    def __init__(
+        self,
+        method: str,
+        pattern: str,
+        handler: Handler,
+        middleware: Sequence[Middleware] = (),
+        limit: Optional[Bulkhead] = None,
+        name: Optional[str] = None,
+        max_body: Optional[int] = None,
+        rate: Optional[RateLimit] = None,
+    ):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.limit = limit
+        self.rate = rate
+        self.name = name or pattern
+        self.max_body = max_body or config.MAX_BODY_BYTES
+        # Precompose the middleware chain once at registration time
+        call: Handler = _traced(handler)
+        for mw in reversed(list(middleware)):
+            call = _bind(mw, call)
+        self._call = call
+
+    def invoke(self, request: Request) -> Response:
+        try:
+            return self._call(request)
+        except HTTPError as e:
+            return error_response(e)
+
+    def admit(self, request: Request) -> Dict[str, str]:
+        """Charge the client's rate limit; returns quota headers, raises HTTPError 429 when spent.
+
+        Runs before the bulkhead and before any body byte is read.
+        """
+        if self.rate is None:
+            return {}
+        try:
+            return self.rate.take(request.client)
+        except RateLimited as e:
+            headers = self.rate.headers(0)
+            headers["Retry-After"] = str(max(1, math.ceil(e.retry_after)))
+            raise HTTPError(HTTPStatus.TOO_MANY_REQUESTS, f"Rate limit exceeded for {self.rate.name}", headers)
+
+    def __call__(self, request: Request) -> Response:
+        """Run the route, holding a slot in its bulkhead (blocking) if it has one."""
+        try:
+            quota = self.admit(request)
+        except HTTPError as e:
+            return error_response(e)
+        if self.limit is None:
+            response = self.invoke(request)
+        else:
+            try:
+                response = self.limit.call(self.invoke, request)
+            except BulkheadFull:
+                response = error_response(busy(self))
+        response.headers.update(quota)
+        return response
+
+
+def _bind(mw: Middleware, nxt: Handler) -> Handler:
+    return lambda request: mw(request, nxt)
+
+
+def _traced(handler: Handler) -> Handler:
+    def call(request: Request) -> Response:
+        with tracing.span("handler"):
+            return handler(request)
+
+    return call
+
+
+def busy(route: Route) -> HTTPError:
+    return HTTPError(
+        HTTPStatus.SERVICE_UNAVAILABLE,
+        f"Too many concurrent {route.limit.name if route.limit else route.name} requests",
+        {"Retry-After": str(config.RETRY_AFTER_SEC)},
+    )
+
+
+def error_response(e: HTTPError) -> Response:
+    return Response({"ok": False, "error": e.message}, status=e.status, headers=dict(e.headers))
+
+
+class _Node:
+    __slots__ = ("static", "params", "routes")
+
+    def __init__(self):
+        self.static: Dict[str, _Node] = {}
+        self.params: List[Tuple[str, Callable[[str], Any], _Node]] = []
+        self.routes: Dict[str, Route] = {}
+
+
+class Router:
+    """Method + path dispatch table.
+
+    Literal paths resolve with one dict lookup; patterns with typed parameters
+    (`/notes/<id>`, `/jobs/<int:n>`) live in a segment trie, so matching costs
+    O(path depth) regardless of how many routes are registered.
+    """
+
+    def __init__(self, middleware: Sequence[Middleware] = ()):
+        self.middleware = list(middleware)
+        self._exact: Dict[Tuple[str, str], Route] = {}
+        self._exact_paths: Dict[str, List[str]] = {}
+        self._root = _Node()
+
+    def add(
+        self,
+        method: str,
+        pattern: str,
+        handler: Handler,
+        middleware: Sequence[Middleware] = (),
+        limit: Optional[Bulkhead] = None,
+        name: Optional[str] = None,
+        max_body: Optional[int] = None,
+        rate: Optional[RateLimit] = None,
+    ) -> Route:
+        method = method.upper()
+        pattern = _normalize(pattern)
+        route = Route(method, pattern, handler, [*self.middleware, *middleware], limit, name, max_body, rate)
+        if "<" not in pattern:
+            self._exact[(method, pattern)] = route
+            self._exact_paths.setdefault(pattern, []).append(method)
+            return route
+
+        node = self._root
+        for seg in _segments(pattern):
+            if seg.startswith("<") and seg.endswith(">"):
+                conv_name, _, param = seg[1:-1].rpartition(":")
+                conv = CONVERTERS[conv_name or "str"]
+                for existing_name, existing_conv, child in node.params:
+                    if existing_name == param and existing_conv is conv:
+                        node = child
+                        break
+                else:
+                    child = _Node()
+                    node.params.append((param, conv, child))
+                    node = child
+            else:
+                node = node.static.setdefault(seg, _Node())
+        node.routes[method] = route
+        return route
+
+    def route(self, method: str, pattern: str, **kwargs: Any) -> Callable[[Handler], Handler]:
+        def decorator(fn: Handler) -> Handler:
+            self.add(method, pattern, fn, **kwargs)
+            return fn
+
+        return decorator
+
+    def match(self, request: Request) -> Route:
+        """Resolve the route for `request` and fill in `request.params`.
+
+        Raises HTTPError 404/405 when nothing matches.
+        """
+        path = _normalize(request.path)
+        route = self._exact.get((request.method, path))
+        if route is not None:
+            request.route = route
+            return route
+
+        params: Dict[str, Any] = {}
+        node = self._walk(self._root, _segments(path), 0, params)
+        if node is not None and request.method in node.routes:
+            request.params = params
+            request.route = node.routes[request.method]
+            return request.route
+
+        allowed = set(self._exact_paths.get(path, ()))
+        if node is not None:
+            allowed.update(node.routes)
+        if allowed:
+            raise HTTPError(
+                HTTPStatus.METHOD_NOT_ALLOWED,
+                f"Method {request.method} not allowed",
+                {"Allow": ", ".join(sorted(allowed))},
+            )
+        raise HTTPError(HTTPStatus.NOT_FOUND, "Not found")
+
+    def _walk(self, node: _Node, segs: List[str], i: int, params: Dict[str, Any]) -> Optional[_Node]:
+        if i == len(segs):
+            return node if node.routes else None
+        seg = segs[i]
+        child = node.static.get(seg)
+        if child is not None:
+            found = self._walk(child, segs, i + 1, params)
+            if found is not None:
+                return found
+        for name, conv, child in node.params:
+            try:
+                value = conv(seg)
+            except ValueError:
+                continue
+            found = self._walk(child, segs, i + 1, params)
+            if found is not None:
+                params[name] = value
+                return found
+        return None
+
+    def dispatch(self, request: Request) -> Response:
+        """Match and run `request` on the calling thread."""
+        try:
+            route = self.match(request)
+        except HTTPError as e:
+            return error_response(e)
+        return route(request)
+
+
+def parse_body(raw: bytes) -> Dict[str, Any]:
+    if not raw:
+        raw = b"{}"
+    try:
+        # json.loads decodes UTF-8 bytes itself; no intermediate str copy of the body
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        # allow form-ish single field bodies like cmd=ls
+        try:
+            s = raw.decode("utf-8")
+            if "=" in s and "{" not in s:
+                return {k: v for k, v in (pair.split("=", 1) for pair in s.split("&"))}
+        except Exception:
+            pass
+        raise
+
+
+def _normalize(path: str) -> str:
+    if len(path) > 1 and path.endswith("/"):
+        return path.rstrip("/") or "/"
+    return path
+
+
+def _segments(path: str) -> List[str]:
+    return [s for s in path.split("/") if s]
+
+
+def timing(request: Request, call_next: Handler) -> Response:
+    """Middleware: report handler wall time in an X-Response-Time header."""
+    start = time.perf_counter()
+    response = call_next(request)
+    response.headers["X-Response-Time"] = f"{(time.perf_counter() - start) * 1000:.2f}ms"
+    return response
+
+
+def server_timing(request: Request, call_next: Handler) -> Response:
+    """Middleware: trace the request and report its stages in a Server-Timing header.
+
+    Spans opened anywhere on this thread while the handler runs (parse, storage,
+    fetch, ...) are collected; requests over SLOW_REQUEST_MS log the whole tree.
+    """
+    if not config.SERVER_TIMING:
+        return call_next(request)
+    if tracing.current() is not None:
+        # A batch item: nest under the batch's trace instead of starting another
+        with tracing.span("route", route=request.route.name if request.route else request.path):
+            return call_next(request)
+    trace = tracing.start()
+    try:
+        try:
+            response = call_next(request)
+        except HTTPError as e:
+            response = error_response(e)
+        if not response.stream and not isinstance(response.body, bytes):
+            with trace.span("serialize"):
+                response.body = response.encode()
+    finally:
+        tracing.stop()
+        trace.finish()
+    response.headers["Server-Timing"] = trace.server_timing()
+    if 0 < config.SLOW_REQUEST_MS <= trace.total_ms:
+        SLOW_LOG.enqueue(
+            {
+                "ts": time.time(),
+                "method": request.method,
+                "path": request.target,
+                "route": request.route.name if request.route else "unmatched",
+                "status": int(response.status),
+                "duration_ms": round(trace.total_ms, 3),
+                "spans": trace.tree(),
+            }
+        )
+    return response
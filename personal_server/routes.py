@@ -0,0 +1,513 @@
+from __future__ import annotations
+
+import io
+import json
+import pstats
+from http import HTTPStatus
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from . import config, memory, metrics
+from .accesslog import ACCESS_LOG
+from .bulkhead import all_stats as bulkhead_stats
+from .bulkhead import get_bulkhead
+from .compression import compress
+from .idempotency import IDEMPOTENCY_CACHE, idempotent
+from .jobs import FINISHED as JOB_FINISHED
+from .jobs import JOBS
+from .profiling import MODES as PROFILE_MODES
+from .profiling import ProfileSession, profile_for, profiled, thread_dump
+from .commands import run_command, run_commands, run_commands_single_shell, run_dag, stream_command
+from .ratelimit import all_stats as rate_limit_stats
+from .ratelimit import get_rate_limit
+from .router import (
+    NDJSON_CONTENT_TYPE,
+    NDJSON_TYPES,
+    HTTPError,
+    Request,
+    Response,
+    Router,
+    close_body,
+    error_response,
+    server_timing,
+    timing,
+)
+from .scraper import fetch_url, html_to_text
+from .sessions import SESSIONS
+from .storage import get_note, save_note, save_scrape, save_transaction, save_weight
+from .utils import csv_batch, read_csv_rows
+
+# Longest ?wait= accepted by GET /jobs/<id>/output
+JOB_OUTPUT_MAX_WAIT = 30.0
+
+
+# Route handlers shared by every server engine.
+
+
+def ping(req: Request) -> Response:
+    return Response({"ok": True, "message": "pong"})
+
+
+def stats(req: Request) -> Response:
+    server_stats = req.server.stats() if hasattr(req.server, "stats") else None
+    access_log = {"written": ACCESS_LOG.written, "dropped": ACCESS_LOG.dropped}
+    return Response(
+        {
+            "ok": True,
+            "server": server_stats,
+            "routes": bulkhead_stats(),
+            "rate_limits": rate_limit_stats(),
+            "access_log": access_log,
+            "idempotency": IDEMPOTENCY_CACHE.stats(),
+            "jobs": JOBS.stats(),
+            "sessions": SESSIONS.stats(),
+        }
+    )
+
+
+def prometheus(req: Request) -> Response:
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def profile(req: Request) -> Response:
+    """Profile this process for ?seconds=N and return the result.
+
+    mode=sample (default) returns collapsed stacks for flamegraph.pl/speedscope;
+    mode=cprofile returns a pstats report, or the binary stats file with format=raw.
+    ?header=X-Profile limits either mode to requests carrying that header.
+    """
+    seconds = req.arg("seconds", 5.0, float)
+    if not 0 < seconds <= config.PROFILE_MAX_SECONDS:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"'seconds' must be in (0, {config.PROFILE_MAX_SECONDS:g}]")
+    mode = req.arg("mode", "sample")
+    if mode not in PROFILE_MODES:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"'mode' must be one of {', '.join(PROFILE_MODES)}")
+    sort = req.arg("sort", "cumulative")
+    if sort not in pstats.Stats.sort_arg_dict_default:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Unknown sort key {sort!r}")
+    interval = req.arg("interval", config.PROFILE_SAMPLE_INTERVAL_MS, float)
+    session = ProfileSession(
+        mode,
+        header=req.arg("header") or None,
+        interval=max(interval, 1.0) / 1000,
+        idle=req.arg("idle", 0, int) != 0,
+    )
+    profile_for(seconds, session)
+    if mode == "sample":
+        return Response(session.collapsed(), content_type="text/plain; charset=utf-8")
+    if req.arg("format") == "raw":
+        if session.stats is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "No requests were profiled")
+        return Response(session.raw(), content_type="application/octet-stream")
+    return Response(session.report(sort, req.arg("limit", 50, int)), content_type="text/plain; charset=utf-8")
+
+
+def threads(req: Request) -> Response:
+    return Response(thread_dump(), content_type="text/plain; charset=utf-8")
+
+
+def memory_status(req: Request) -> Response:
+    return Response({"ok": True, **memory.status()})
+
+
+def memory_start(req: Request) -> Response:
+    frames = req.arg("frames", config.TRACEMALLOC_FRAMES, int)
+    if frames < 1:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "'frames' must be at least 1")
+    memory.start(frames)
+    return Response({"ok": True, **memory.status()})
+
+
+def memory_stop(req: Request) -> Response:
+    memory.stop()
+    return Response({"ok": True, **memory.status()})
+
+
+def memory_snapshot(req: Request) -> Response:
+    snapshot_id, snapshot = memory.SNAPSHOTS.take()
+    return Response({"ok": True, "id": snapshot_id, "traces": len(snapshot.traces)})
+
+
+def _memory_key(req: Request) -> str:
+    key = req.arg("key", "lineno")
+    if key not in memory.KEYS:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"'key' must be one of {', '.join(memory.KEYS)}")
+    return key
+
+
+def memory_top(req: Request) -> Response:
+    """Top allocation sites in ?snapshot=<id>, or in a fresh snapshot."""
+    key = _memory_key(req)
+    snapshot_id = req.arg("snapshot", None, int)
+    if snapshot_id is None:
+        snapshot_id, snapshot = memory.SNAPSHOTS.take()
+    else:
+        snapshot = memory.SNAPSHOTS.get(snapshot_id)
+    return Response({"ok": True, "snapshot": snapshot_id, **memory.top(snapshot, key, req.arg("limit", 20, int))})
+
+
+def memory_diff(req: Request) -> Response:
+    """Allocation growth from ?from=<id> to ?to=<id> (default: a fresh snapshot)."""
+    key = _memory_key(req)
+    old_id = req.arg("from", None, int)
+    if old_id is None:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing 'from' snapshot id")
+    old = memory.SNAPSHOTS.get(old_id)
+    new_id = req.arg("to", None, int)
+    if new_id is None:
+        new_id, new = memory.SNAPSHOTS.take()
+    else:
+        new = memory.SNAPSHOTS.get(new_id)
+    result = memory.diff(old, new, key, req.arg("limit", 20, int))
+    return Response({"ok": True, "from": old_id, "to": new_id, **result})
+
+
+def run(req: Request) -> Response:
+    body = req.json()
+    timeout = body.get("timeout")
+    cwd = body.get("cwd")
+
+    # Accept single string or list of commands
+    commands = None
+    if isinstance(body.get("cmds"), list):
+        commands = body.get("cmds")
+    elif isinstance(body.get("commands"), list):
+        commands = body.get("commands")
+    elif isinstance(body.get("cmd"), list):
+        commands = body.get("cmd")
+
+    if body.get("async"):
+        cmd = body.get("cmd") or body.get("command")
+        if commands is not None or not cmd or not str(cmd).strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Async jobs need a single 'cmd' string")
+        job = JOBS.submit(str(cmd), timeout=timeout, cwd=cwd)
+        return Response(
+            {"ok": True, "job": job.status()},
+            status=HTTPStatus.ACCEPTED,
+            headers={"Location": f"/jobs/{job.id}"},
+        )
+
+    if body.get("stream"):
+        cmd = body.get("cmd") or body.get("command")
+        if commands is not None or not cmd or not str(cmd).strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Streaming needs a single 'cmd' string")
+        # The command outlives this call, so its /run slot is held until the body is done
+        release = req.route.limit.detach() if req.route and req.route.limit else None
+        return _stream_response(stream_command(str(cmd), timeout=timeout, cwd=cwd), release)
+
+    if body.get("steps") is not None:
+        # dependency graph of named steps
+        parallel = _parallel(body, config.RUN_MAX_PARALLEL)
+        try:
+            agg = run_dag(
+                body["steps"],
+                timeout=timeout,
+                cwd=cwd,
+                parallel=parallel,
+                stop_on_error=bool(body.get("stop_on_error", False)),
+            )
+        except ValueError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+        return _run_response(agg, agg["steps"])
+
+    if commands is not None:
+        # sequential execution of multiple commands
+        stop_on_error = bool(body.get("stop_on_error", False))
+        # coerce all entries to strings
+        commands = [str(c) for c in commands]
+        parallel = _parallel(body, 1)
+        if bool(body.get("single_shell", False)):
+            if parallel > 1:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "'parallel' cannot be combined with 'single_shell'")
+            agg = run_commands_single_shell(commands, timeout=timeout, cwd=cwd, stop_on_error=stop_on_error)
+        else:
+            agg = run_commands(commands, timeout=timeout, cwd=cwd, stop_on_error=stop_on_error, parallel=parallel)
+        return _run_response(agg, agg["results"])
+
+    # Fallback: single command string
+    cmd = body.get("cmd") or body.get("command")
+    if not cmd or not str(cmd).strip():
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing 'cmd' or 'cmds'")
+    result = run_command(str(cmd), timeout=timeout, cwd=cwd)
+    return _run_response(result, [result])
+
+
+def _parallel(body: Dict[str, Any], default: int) -> int:
+    parallel = body.get("parallel", default)
+    if not isinstance(parallel, int) or isinstance(parallel, bool) or parallel < 1:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "'parallel' must be a positive integer")
+    return min(parallel, config.RUN_MAX_PARALLEL)
+
+
+def _run_response(payload: Dict[str, Any], results: List[Dict[str, Any]]) -> Response:
+    # Large outputs are encoded incrementally and sent chunked instead of as one buffer
+    size = sum(len(r.get("stdout") or "") + len(r.get("stderr") or "") for r in results)
+    return Response(payload, stream=size > config.STREAM_THRESHOLD_BYTES)
+
+
+def _stream_response(batches: Iterator[List[Dict[str, Any]]], release: Optional[Callable[[], None]] = None) -> Response:
+    # One NDJSON piece per read from the command's pipes, each written out as soon as it exists
+    def lines() -> Iterator[str]:
+        try:
+            for batch in batches:
+                yield "".join(json.dumps(event) + "\n" for event in batch)
+        finally:
+            try:
+                close_body(batches)
+            finally:
+                if release is not None:
+                    release()
+
+    return Response(lines(), content_type=NDJSON_CONTENT_TYPE, stream=True, chunk_size=1)
+
+
+def job_detail(req: Request) -> Response:
+    return Response({"ok": True, "job": JOBS.get(req.params["id"]).status()})
+
+
+def job_output(req: Request) -> Response:
+    """Output events from ?offset= on; ?wait=N long-polls up to N seconds for new ones."""
+    job = JOBS.get(req.params["id"])
+    offset = max(0, req.arg("offset", 0, int))
+    limit = max(1, req.arg("limit", 1000, int))
+    wait = min(max(0.0, req.arg("wait", 0.0, float)), JOB_OUTPUT_MAX_WAIT)
+    return Response({"ok": True, "state": job.state, **job.output(offset, limit, wait)})
+
+
+def job_cancel(req: Request) -> Response:
+    """Cancel a queued or running job; deleting a finished one forgets it."""
+    job = JOBS.get(req.params["id"])
+    if job.state in JOB_FINISHED:
+        JOBS.remove(job.id)
+    else:
+        job.cancel()
+    return Response({"ok": True, "job": job.status()})
+
+
+def session_create(req: Request) -> Response:
+    body = req.json() if req.body() else {}
+    env = body.get("env")
+    if env is not None and not isinstance(env, dict):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "'env' must be an object")
+    session = SESSIONS.create(
+        cwd=body.get("cwd"),
+        env={str(k): str(v) for k, v in env.items()} if env else None,
+    )
+    return Response(
+        {"ok": True, "session": session.status()},
+        status=HTTPStatus.CREATED,
+        headers={"Location": f"/sessions/{session.id}"},
+    )
+
+
+def session_list(req: Request) -> Response:
+    return Response({"ok": True, "sessions": SESSIONS.list()})
+
+
+def session_detail(req: Request) -> Response:
+    return Response({"ok": True, "session": SESSIONS.get(req.params["id"]).status()})
+
+
+def session_run(req: Request) -> Response:
+    """Run `cmd` or `cmds` in the session's shell; cwd and environment carry over between requests."""
+    body = req.json()
+    commands = body.get("cmds") or body.get("commands")
+    if commands is None:
+        cmd = body.get("cmd") or body.get("command")
+        commands = cmd if isinstance(cmd, list) else [cmd] if cmd and str(cmd).strip() else None
+    if not isinstance(commands, list) or not commands:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing 'cmd' or 'cmds'")
+    agg = SESSIONS.run(
+        req.params["id"],
+        [str(c) for c in commands],
+        timeout=body.get("timeout"),
+        stop_on_error=bool(body.get("stop_on_error", False)),
+    )
+    return _run_response(agg, agg["results"])
+
+
+def session_close(req: Request) -> Response:
+    session = SESSIONS.remove(req.params["id"])
+    if session is None:
+        raise HTTPError(HTTPStatus.NOT_FOUND, "Session not found")
+    return Response({"ok": True, "session": session.status()})
+
+
+def notes(req: Request) -> Response:
+    body = req.json()
+    title = (body.get("title") or "").strip()
+    content = body.get("content") or ""
+    tags = body.get("tags")
+    if not title:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing 'title'")
+    rec = save_note(title=title, content=content, tags=",".join(tags) if isinstance(tags, list) else tags)
+    return Response({"ok": True, "note": rec.__dict__})
+
+
+def note_detail(req: Request) -> Response:
+    note = get_note(req.params["id"])
+    if note is None:
+        raise HTTPError(HTTPStatus.NOT_FOUND, "Note not found")
+    return Response({"ok": True, "note": note})
+
+
+def transactions(req: Request) -> Response:
+    if req.content_type in NDJSON_TYPES:
+        # Bulk import: one record per line, saved as it is read
+        count = sum(1 for payload in req.ndjson() if save_transaction(payload))
+        return Response({"ok": True, "imported": count})
+    rec = save_transaction(req.json())
+    return Response({"ok": True, "transaction": rec.__dict__})
+
+
+def scrape(req: Request) -> Response:
+    url = req.json().get("url")
+    if not url:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Missing 'url'")
+    try:
+        final_url, html_text, title = fetch_url(url)
+        text = html_to_text(html_text)
+        rec = save_scrape(final_url, html_text, text, title)
+        return Response({"ok": True, "scrape": rec.__dict__})
+    except Exception as e:
+        raise HTTPError(HTTPStatus.BAD_GATEWAY, f"Scrape failed: {e}")
+
+
+def export_transactions(req: Request) -> Response:
+    return Response.ndjson(read_csv_rows(config.TRANSACTIONS_CSV))
+
+
+def export_weights(req: Request) -> Response:
+    return Response.ndjson(read_csv_rows(config.WEIGHTS_CSV))
+
+
+def weights(req: Request) -> Response:
+    if req.content_type in NDJSON_TYPES:
+        count = sum(1 for payload in req.ndjson() if save_weight(payload))
+        return Response({"ok": True, "imported": count})
+    rec = save_weight(req.json())
+    return Response({"ok": True, "weight": rec.__dict__})
+
+
+def batch(req: Request) -> Response:
+    """Run many {route, body} operations through their normal handlers.
+
+    CSV rows from every item are written once per file when the batch ends.
+    """
+    body = req.json_value()
+    ops = body.get("operations") if isinstance(body, dict) else body
+    if not isinstance(ops, list):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected a JSON array of {route, body} operations")
+    if len(ops) > config.BATCH_MAX_OPERATIONS:
+        raise HTTPError(
+            HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+            f"Too many operations ({len(ops)} > {config.BATCH_MAX_OPERATIONS})",
+        )
+    with csv_batch():
+        results = [_batch_item(req, op) for op in ops]
+    return Response({"ok": all(r["ok"] for r in results), "results": results})
+
+
+def _batch_item(req: Request, op: Any) -> Dict[str, Any]:
+    path = op.get("route") if isinstance(op, dict) else None
+    if not isinstance(path, str):
+        response = error_response(HTTPError(HTTPStatus.BAD_REQUEST, "Operation needs a 'route' string"))
+        return {"route": path, "ok": False, "status": response.status, "body": response.body}
+    data = json.dumps(op.get("body") or {}).encode("utf-8")
+    sub = Request(
+        str(op.get("method") or "POST").upper(),
+        path,
+        {"Content-Type": "application/json", "Content-Length": str(len(data))},
+        io.BytesIO(data),
+        client=req.client,
+        server=req.server,
+    )
+    try:
+        route = router.match(sub)
+        if route.handler is batch:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Batches cannot nest")
+    except HTTPError as e:
+        response = error_response(e)
+    else:
+        try:
+            response = route(sub)
+        except Exception as e:
+            # One broken item must not take down the rows already written for the others
+            response = error_response(HTTPError(HTTPStatus.INTERNAL_SERVER_ERROR, f"Internal error: {e}"))
+    body = response.body
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    elif not isinstance(body, (dict, list, str)):
+        if hasattr(body, "close"):
+            body.close()
+        response = error_response(HTTPError(HTTPStatus.BAD_REQUEST, "Streamed responses cannot be batched"))
+        body = response.body
+    return {"route": path, "ok": response.status < 400, "status": int(response.status), "body": body}
+
+
+# Dispatch table, built once at import
+router = Router(middleware=[profiled, memory.memory_tracked, server_timing, timing, compress])
+router.add("GET", "/ping", ping)
+router.add("GET", "/admin/stats", stats)
+router.add("GET", "/admin/profile", profile, limit=get_bulkhead("/admin"))
+router.add("GET", "/admin/threads", threads)
+router.add("GET", "/admin/memory", memory_status)
+router.add("POST", "/admin/memory/start", memory_start)
+router.add("POST", "/admin/memory/stop", memory_stop)
+router.add("POST", "/admin/memory/snapshots", memory_snapshot, limit=get_bulkhead("/admin"))
+router.add("GET", "/admin/memory/top", memory_top, limit=get_bulkhead("/admin"))
+router.add("GET", "/admin/memory/diff", memory_diff, limit=get_bulkhead("/admin"))
+router.add("GET", "/metrics", prometheus)
+router.add("POST", "/run", run, limit=get_bulkhead("/run"), rate=get_rate_limit("/run"))
+router.add(
+    "POST",
+    "/notes",
+    notes,
+    middleware=[idempotent],
+    limit=get_bulkhead("/notes"),
+    rate=get_rate_limit("/notes"),
+)
+router.add("GET", "/notes/<id>", note_detail, limit=get_bulkhead("/notes"))
+router.add(
+    "POST",
+    "/transactions",
+    transactions,
+    middleware=[idempotent],
+    limit=get_bulkhead("/transactions"),
+    rate=get_rate_limit("/transactions"),
+    max_body=config.MAX_IMPORT_BODY_BYTES,
+)
+router.add("GET", "/jobs/<id>", job_detail)
+router.add("GET", "/jobs/<id>/output", job_output, limit=get_bulkhead("/jobs"))
+router.add("DELETE", "/jobs/<id>", job_cancel)
+router.add("POST", "/sessions", session_create, limit=get_bulkhead("/sessions"), rate=get_rate_limit("/sessions"))
+router.add("GET", "/sessions", session_list)
+router.add("GET", "/sessions/<id>", session_detail)
+router.add(
+    "POST",
+    "/sessions/<id>/run",
+    session_run,
+    limit=get_bulkhead("/sessions"),
+    rate=get_rate_limit("/sessions"),
+)
+# Closing waits for the shell to exit, so it runs on the bulkhead's threads too, never on the asyncio loop
+router.add("DELETE", "/sessions/<id>", session_close, limit=get_bulkhead("/sessions"))
+router.add("GET", "/transactions", export_transactions)
+router.add("POST", "/scrape", scrape, limit=get_bulkhead("/scrape"), rate=get_rate_limit("/scrape"))
+router.add(
+    "POST",
+    "/weights",
+    weights,
+    middleware=[idempotent],
+    limit=get_bulkhead("/weights"),
+    rate=get_rate_limit("/weights"),
+    max_body=config.MAX_IMPORT_BODY_BYTES,
+)
+router.add("GET", "/weights", export_weights)
+router.add(
+    "POST",
+    "/batch",
+    batch,
+    middleware=[idempotent],
+    limit=get_bulkhead("/batch"),
+    rate=get_rate_limit("/batch"),
+)
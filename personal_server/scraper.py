@@ -2,10 +2,14 @@ from __future__ import annotations
 
 import html
 import re
+import time
 import urllib.request
 from html.parser import HTMLParser
 from typing import Tuple
 
+from . import tracing
+from .metrics import SCRAPE_BYTES, SCRAPE_SECONDS
+
 
 class _TextExtractor(HTMLParser):
     def __init__(self):
@@ -24,18 +28,30 @@ class _TextExtractor(HTMLParser):
 def fetch_url(url: str, timeout: int = 20) -> Tuple[str, str, str]:
     """Return (final_url, html, title)"""
     req = urllib.request.Request(url, headers={"User-Agent": "PersonalServer/1.0"})
-    with urllib.request.urlopen(req, timeout=timeout) as resp:
-        charset = resp.headers.get_content_charset() or "utf-8"
-        html_bytes = resp.read()
-        html_text = html_bytes.decode(charset, errors="replace")
-        title = _extract_title(html_text)
-        return str(resp.geturl()), html_text, title
+    start = time.perf_counter()
+    try:
+        # "fetch.connect" covers DNS, connect, TLS and response headers; urllib does not split them
+        with tracing.span("fetch.connect", url=url):
+            resp = urllib.request.urlopen(req, timeout=timeout)
+        with resp, tracing.span("fetch.read"):
+            charset = resp.headers.get_content_charset() or "utf-8"
+            html_bytes = resp.read()
+            final_url = str(resp.geturl())
+    except Exception:
+        SCRAPE_SECONDS.observe(time.perf_counter() - start, "error")
+        raise
+    SCRAPE_SECONDS.observe(time.perf_counter() - start, "ok")
+    SCRAPE_BYTES.observe(len(html_bytes))
+    html_text = html_bytes.decode(charset, errors="replace")
+    title = _extract_title(html_text)
+    return final_url, html_text, title
 
 
 def html_to_text(html_text: str) -> str:
-    parser = _TextExtractor()
-    parser.feed(html_text)
-    return parser.get_text()
+    with tracing.span("html_to_text", chars=len(html_text)):
+        parser = _TextExtractor()
+        parser.feed(html_text)
+        return parser.get_text()
 
 
 def _extract_title(html_text: str) -> str:
@@ -1,128 +1,301 @@
 from __future__ import annotations
 
-import json
+import os
+import signal
+import socket
+import threading
+import time
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Any, Dict
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from typing import List
 
-from . import config
-from .commands import run_command, run_commands, run_commands_single_shell
-from .scraper import fetch_url, html_to_text
-from .storage import save_note, save_scrape, save_transaction, save_weight
+from . import config, metrics
+from .accesslog import ACCESS_LOG, SLOW_LOG
+from .bodies import BodyError, body_framing
+from .bulkhead import shutdown_all
+from .commands import terminate_all
+from .jobs import JOBS
+from .sessions import SESSIONS
+from .pool import PooledHTTPServer
+from .router import JSON_CONTENT_TYPE, Request, Response, close_body
+from .routes import router
+from .utils import unix_listener
+
+
+_TURNED_AWAY = (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE)
+
+
+def _has_body(request: Request) -> bool:
+    try:
+        length, chunked = body_framing(request.headers)
+    except BodyError:
+        return True
+    return chunked or length > 0
 
 
 class Handler(BaseHTTPRequestHandler):
     server_version = "PersonalServer/0.1"
+    # Persistent connections: idle sockets time out, busy ones are recycled
+    protocol_version = "HTTP/1.1"
+    # Backstop only: the pool's reaper enforces the idle and header deadlines
+    timeout = config.KEEPALIVE_TIMEOUT + config.HEADER_TIMEOUT
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # TCP_NODELAY is a TCP option; Unix socket connections would reject it
+        self.disable_nagle_algorithm = self.request.family != socket.AF_UNIX
+        super().setup()
+        self.requests_served = 0
+
+    def address_string(self):
+        # Unix socket peers have no address
+        return self.client_address[0] if self.client_address else "unix"
 
     def log_message(self, fmt, *args):
         # Lean logging
         return super().log_message(fmt, *args)
 
+    def log_request(self, code="-", size="-"):
+        # Per-request lines go to the background access log instead of stderr
+        pass
+
+    def handle_one_request(self):
+        # Waiting for the next request line: reaped after the keep-alive timeout, by a drain,
+        # or when too many connections are idle
+        self.connection.settimeout(self.timeout)
+        self.server.watch(self.connection, "idle", config.KEEPALIVE_TIMEOUT)
+        super().handle_one_request()
+
+    def parse_request(self):
+        if not self.raw_requestline.endswith(b"\n"):
+            # Cut off mid request line (reaped): nothing safe to answer
+            self.close_connection = True
+            return False
+        # Headers must be complete within HEADER_TIMEOUT however slowly they trickle in
+        self.server.watch(self.connection, "header", config.HEADER_TIMEOUT)
+        ok = super().parse_request()
+        if not self.server.unwatch(self.connection):
+            # Reaped while reading headers: what was parsed may be truncated
+            self.close_connection = True
+            return False
+        # From here on each body read may block for at most BODY_TIMEOUT
+        self.connection.settimeout(config.BODY_TIMEOUT)
+        return ok
+
     # Routing
-    def do_GET(self):
-        if self.path.startswith("/ping"):
-            return self._json({"ok": True, "message": "pong"})
-        return self._json({"ok": False, "error": "Not found"}, status=HTTPStatus.NOT_FOUND)
+    def _dispatch(self):
+        start = time.perf_counter()
+        request = Request(
+            self.command,
+            self.path,
+            self.headers,
+            self.rfile,
+            client=self.address_string(),
+            server=self.server,
+        )
+        response = router.dispatch(request)
+        # Pipelined requests share the stream: skip a small unread body, or give up on the connection.
+        # A request turned away before its body was read is not drained at all: a slow uploader
+        # would hold this worker for as long as a request that was let in.
+        turned_away = response.status in _TURNED_AWAY and request.bytes_read == 0
+        if (turned_away and _has_body(request)) or not request.discard_body():
+            self.close_connection = True
+        self.connection.settimeout(config.WRITE_TIMEOUT)
+        try:
+            sent = self._send(response)
+        except TimeoutError:
+            # The client stopped reading; give up on it instead of holding the worker
+            metrics.CONNECTIONS_REAPED.inc("write_timeout")
+            self.close_connection = True
+            sent = 0
+        route = request.route.name if request.route else "unmatched"
+        elapsed = time.perf_counter() - start
+        metrics.observe_request(route, self.command, response.status, elapsed)
+        ACCESS_LOG.record(
+            request.client,
+            self.command,
+            self.path,
+            route,
+            response.status,
+            request.bytes_read,
+            sent,
+            elapsed,
+        )
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _dispatch
+
+    # Helpers
+    def _connection_headers(self) -> None:
+        self.requests_served += 1
+        # Give the worker back when connections are queueing for one
+        saturated = getattr(self.server, "saturated", False) or getattr(self.server, "draining", False)
+        if self.close_connection or saturated or self.requests_served >= config.KEEPALIVE_MAX_REQUESTS:
+            self.send_header("Connection", "close")
+            return
+        self.send_header("Connection", "keep-alive")
+        remaining = config.KEEPALIVE_MAX_REQUESTS - self.requests_served
+        self.send_header("Keep-Alive", f"timeout={int(config.KEEPALIVE_TIMEOUT)}, max={remaining}")
+
+    def _send(self, response: Response) -> int:
+        if response.stream:
+            return self._send_stream(response)
+        data = response.encode()
+        self.send_response(response.status)
+        self.send_header("Content-Type", response.content_type or JSON_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self._connection_headers()
+        self.end_headers()
+        self.wfile.write(data)
+        return len(data)
 
-    def do_POST(self):
+    def _send_stream(self, response: Response) -> int:
+        # HTTP/1.0 clients get a close-delimited body instead of chunks
+        chunked = self.request_version == "HTTP/1.1"
+        if not chunked:
+            self.close_connection = True
+        self.send_response(response.status)
+        self.send_header("Content-Type", response.content_type or JSON_CONTENT_TYPE)
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        self._connection_headers()
+        self.end_headers()
+        sent = 0
+        chunks = response.chunks()
         try:
-            body = self._json_body()
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                    sent += len(chunk)
+            if chunked:
+                self.wfile.write(b"0\r\n\r\n")
         except Exception as e:
-            return self._json({"ok": False, "error": f"Invalid JSON: {e}"}, status=HTTPStatus.BAD_REQUEST)
-
-        if self.path.startswith("/run"):
-            timeout = body.get("timeout")
-            cwd = body.get("cwd")
-
-            # Accept single string or list of commands
-            commands = None
-            if isinstance(body.get("cmds"), list):
-                commands = body.get("cmds")
-            elif isinstance(body.get("commands"), list):
-                commands = body.get("commands")
-            elif isinstance(body.get("cmd"), list):
-                commands = body.get("cmd")
-
-            if commands is not None:
-                # sequential execution of multiple commands
-                stop_on_error = bool(body.get("stop_on_error", False))
-                # coerce all entries to strings
-                commands = [str(c) for c in commands]
-                if bool(body.get("single_shell", False)):
-                    agg = run_commands_single_shell(commands, timeout=timeout, cwd=cwd, stop_on_error=stop_on_error)
-                else:
-                    agg = run_commands(commands, timeout=timeout, cwd=cwd, stop_on_error=stop_on_error)
-                return self._json(agg)
-
-            # Fallback: single command string
-            cmd = body.get("cmd") or body.get("command")
-            if not cmd or not str(cmd).strip():
-                return self._json({"ok": False, "error": "Missing 'cmd' or 'cmds'"}, status=HTTPStatus.BAD_REQUEST)
-            result = run_command(str(cmd), timeout=timeout, cwd=cwd)
-            return self._json(result)
-
-        if self.path.startswith("/notes"):
-            title = (body.get("title") or "").strip()
-            content = body.get("content") or ""
-            tags = body.get("tags")
-            if not title:
-                return self._json({"ok": False, "error": "Missing 'title'"}, status=HTTPStatus.BAD_REQUEST)
-            rec = save_note(title=title, content=content, tags=",".join(tags) if isinstance(tags, list) else tags)
-            return self._json({"ok": True, "note": rec.__dict__})
-
-        if self.path.startswith("/transactions"):
-            rec = save_transaction(body)
-            return self._json({"ok": True, "transaction": rec.__dict__})
-
-        if self.path.startswith("/scrape"):
-            url = body.get("url")
-            if not url:
-                return self._json({"ok": False, "error": "Missing 'url'"}, status=HTTPStatus.BAD_REQUEST)
-            try:
-                final_url, html_text, title = fetch_url(url)
-                text = html_to_text(html_text)
-                rec = save_scrape(final_url, html_text, text, title)
-                return self._json({"ok": True, "scrape": rec.__dict__})
-            except Exception as e:
-                return self._json({"ok": False, "error": f"Scrape failed: {e}"}, status=HTTPStatus.BAD_GATEWAY)
+            # Status line is already out; drop the connection so the client sees a truncated body
+            if isinstance(e, TimeoutError):
+                metrics.CONNECTIONS_REAPED.inc("write_timeout")
+            self.close_connection = True
+            self.log_error("streaming %s failed: %r", self.path, e)
+        finally:
+            close_body(chunks)
+        return sent
 
-        if self.path.startswith("/weights"):
-            rec = save_weight(body)
-            return self._json({"ok": True, "weight": rec.__dict__})
 
-        return self._json({"ok": False, "error": "Not found"}, status=HTTPStatus.NOT_FOUND)
+def run_server(
+    host: str | None = None,
+    port: int | None = None,
+    engine: str | None = None,
+    workers: int | None = None,
+    unix_socket: str | Path | None = None,
+    unix_socket_mode: int | None = None,
+    tcp: bool | None = None,
+):
+    """Serve on TCP, a Unix domain socket, or both (`tcp=False` for the socket alone)."""
+    engine = engine or config.DEFAULT_ENGINE
+    if engine not in ("threaded", "asyncio"):
+        raise ValueError(f"Unknown engine: {engine!r} (expected 'threaded' or 'asyncio')")
+    workers = workers or config.WORKERS
+    unix_socket = unix_socket or config.UNIX_SOCKET
+    tcp = config.TCP_ENABLED if tcp is None else tcp
+    if not tcp and not unix_socket:
+        raise ValueError("Nothing to listen on: TCP is disabled and no unix_socket was given")
+    host = host or config.DEFAULT_HOST
+    port = port or config.DEFAULT_PORT
 
-    # Helpers
-    def _json_body(self) -> Dict[str, Any]:
-        length = int(self.headers.get("Content-Length") or 0)
-        raw = self.rfile.read(length) if length > 0 else b"{}"
-        try:
-            return json.loads(raw.decode("utf-8"))
-        except json.JSONDecodeError:
-            # allow form-ish single field bodies like cmd=ls
+    # Bound once up front; prefork workers inherit the listening socket
+    unix_sock = None
+    if unix_socket:
+        unix_socket = Path(unix_socket)
+        mode = config.UNIX_SOCKET_MODE if unix_socket_mode is None else unix_socket_mode
+        unix_sock = unix_listener(unix_socket, mode, config.LISTEN_BACKLOG)
+    try:
+        if workers > 1:
+            from .prefork import Supervisor
+
+            where = ", ".join(_addresses(host if tcp else None, port, unix_socket))
+            print(f"PersonalServer supervisor {os.getpid()}: {workers} {engine} workers on {where}")
+            # Give workers time to drain before the supervisor resorts to SIGKILL
+            grace = config.SHUTDOWN_GRACE_SEC + 2 * config.SHUTDOWN_KILL_GRACE_SEC + 1
+            worker = lambda: serve(host if tcp else None, port, engine, reuse_port=True, unix_sock=unix_sock)
+            Supervisor(workers, worker, grace=grace).run()
+            return
+        serve(host if tcp else None, port, engine, unix_sock=unix_sock)
+    finally:
+        if unix_sock is not None:
+            unix_sock.close()
             try:
-                s = raw.decode("utf-8")
-                if "=" in s and "{" not in s:
-                    return {k: v for k, v in (pair.split("=", 1) for pair in s.split("&"))}
-            except Exception:
+                os.unlink(unix_socket)
+            except OSError:
                 pass
-            raise
 
-    def _json(self, obj: Dict[str, Any], status: int = 200):
-        data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
-        self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
-        self.send_header("Content-Length", str(len(data)))
-        self.end_headers()
-        self.wfile.write(data)
 
+def _addresses(host: str | None, port: int, unix_socket: Path | None) -> List[str]:
+    out = [f"http://{host}:{port}"] if host else []
+    if unix_socket:
+        out.append(f"unix:{unix_socket}")
+    return out
+
+
+def serve(
+    host: str | None = None,
+    port: int | None = None,
+    engine: str = "threaded",
+    reuse_port: bool = False,
+    unix_sock: socket.socket | None = None,
+):
+    """Run one server process until interrupted.
+
+    `host=None` with a `unix_sock` serves the Unix socket alone.
+    """
+    if engine == "asyncio":
+        from .aioserver import run_async_server
+
+        return run_async_server(host, port, reuse_port=reuse_port, unix_sock=unix_sock)
 
-def run_server(host: str | None = None, port: int | None = None):
-    server = ThreadingHTTPServer((host or config.DEFAULT_HOST, port or config.DEFAULT_PORT), Handler)
+    servers = []
+    if host:
+        servers.append(PooledHTTPServer((host, port or config.DEFAULT_PORT), Handler, reuse_port=reuse_port))
+    if unix_sock is not None:
+        servers.append(PooledHTTPServer(unix_sock.getsockname(), Handler, sock=unix_sock))
+    if threading.current_thread() is threading.main_thread():
+        # SIGTERM (rolling restarts, the prefork supervisor) takes the same path as Ctrl-C
+        signal.signal(signal.SIGTERM, _interrupt)
+    # Each listener has its own worker pool; all but the first accept on background threads
+    background = servers[1:]
+    for server in background:
+        threading.Thread(target=server.serve_forever, name="ps-listener", daemon=True).start()
     try:
-        print(f"PersonalServer running on http://{server.server_address[0]}:{server.server_address[1]}")
-        server.serve_forever()
+        where = ", ".join(_addresses(host, port or config.DEFAULT_PORT, unix_sock and unix_sock.getsockname()))
+        print(f"PersonalServer running on {where}")
+        servers[0].serve_forever()
     except KeyboardInterrupt:
         print("\nShutting down...")
     finally:
-        server.server_close()
+        for server in background:
+            server.shutdown()
+        if not _drain(servers, config.SHUTDOWN_GRACE_SEC):
+            # Deadline passed: stop running commands so their requests can still answer
+            terminate_all(config.SHUTDOWN_KILL_GRACE_SEC)
+            _drain(servers, config.SHUTDOWN_KILL_GRACE_SEC)
+        for server in servers:
+            server.server_close()
+        JOBS.shutdown()
+        SESSIONS.shutdown()
+        shutdown_all()
+        ACCESS_LOG.close()
+        SLOW_LOG.close()
+
+
+def _drain(servers: List[PooledHTTPServer], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    drained = True
+    for server in servers:
+        drained = server.drain(max(0.0, deadline - time.monotonic())) and drained
+    return drained
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
@@ -0,0 +1,319 @@
+from __future__ import annotations
+
+import os
+import selectors
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Any, Dict, List, Optional
+
+from . import config
+from .commands import cancel_command
+from .metrics import COMMAND_SECONDS
+from .router import HTTPError
+
+
+def _quote(cmd: str) -> str:
+    return "'" + cmd.replace("'", "'\\''") + "'"
+
+
+class ShellSession:
+    """A long-lived `/bin/sh` that runs commands sent over its stdin.
+
+    Uses the same delimiter protocol as `run_commands_single_shell`: each command
+    is bracketed by BEGIN/END marker lines carrying its index, exit code and the
+    shell's working directory afterwards. Commands go through `command eval`, so a
+    syntax error fails that command instead of the shell, and read /dev/null, so
+    they cannot swallow the next command. stderr is merged into stdout.
+    """
+
+    def __init__(self, cwd: Optional[str] = None, env: Optional[Dict[str, str]] = None):
+        self.id = uuid.uuid4().hex
+        self.delim = f"__PS_DELIM_{uuid.uuid4().hex}__"
+        self.created = time.time()
+        self.last_used = time.monotonic()
+        self.commands = 0
+        self.cwd = cwd
+        self.busy = threading.Lock()
+        # Held while a command talks to the shell; close() takes it before closing the pipes
+        self._io = threading.Lock()
+        self._buffer = b""
+        self._closed = False
+        self.proc = subprocess.Popen(
+            ["/bin/sh"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=cwd or None,
+            env={**os.environ, **env} if env else None,
+            start_new_session=True,
+        )
+
+    @property
+    def alive(self) -> bool:
+        return not self._closed and self.proc.poll() is None
+
+    def run(self, cmds: List[str], timeout: Optional[float] = None, stop_on_error: bool = False) -> Dict:
+        """Run `cmds` one after another; `timeout` bounds the whole call and kills the session."""
+        results: List[Dict] = []
+        stopped = False
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            for raw in cmds:
+                c = str(raw)
+                result = self._run_one(c, deadline)
+                results.append({"cmd": c, **result})
+                if not self.alive or (stop_on_error and not result["ok"]):
+                    stopped = len(results) < len(cmds)
+                    break
+        finally:
+            self.last_used = time.monotonic()
+        return {
+            "ok": all(r["ok"] for r in results),
+            "stop_on_error": stop_on_error,
+            "stopped": stopped,
+            "alive": self.alive,
+            "cwd": self.cwd,
+            "results": results,
+        }
+
+    def _run_one(self, cmd: str, deadline: Optional[float]) -> Dict:
+        with self._io:
+            return self._run_locked(cmd, deadline)
+
+    def _run_locked(self, cmd: str, deadline: Optional[float]) -> Dict:
+        index = self.commands
+        self.commands += 1
+        start = time.time()
+        # The END marker goes after a newline of its own, so output without a trailing
+        # newline (printf foo) cannot hide it mid-line; that newline is dropped again below
+        script = (
+            f'echo "{self.delim} BEGIN {index}"\n'
+            f"command eval {_quote(cmd)} </dev/null\n"
+            f'__ps_status=$?; echo; echo "{self.delim} END {index} $__ps_status $PWD"\n'
+        )
+        if self._closed:
+            return self._result(start, None, b"", "ERROR: session closed", record=False)
+        try:
+            self.proc.stdin.write(script.encode("utf-8"))
+            self.proc.stdin.flush()
+        except (OSError, ValueError):
+            # ValueError: close() shut stdin under us
+            error = "session closed" if self._closed else "session has exited"
+            return self._result(start, None, b"", f"ERROR: {error}")
+
+        begin = f"{self.delim} BEGIN {index}".encode()
+        end = f"{self.delim} END {index} ".encode()
+        output: List[bytes] = []
+        started = False
+        while True:
+            line = self._readline(deadline)
+            if line is None:
+                # Timed out: the shell cannot be interrupted mid-command, so it goes
+                self._closed = True
+                cancel_command(self.proc, 0)
+                COMMAND_SECONDS.observe(time.time() - start, "timeout")
+                return self._result(start, None, b"".join(output), "TIMEOUT", record=False)
+            if line == b"":
+                # EOF: the command ended the shell (exit, exec, ...), or close() killed it
+                error = "session closed" if self._closed else "session has exited"
+                self._closed = True
+                code = self.proc.wait()
+                return self._result(start, code, b"".join(output), error)
+            if not started:
+                started = line.rstrip(b"\n") == begin
+                continue
+            if line.startswith(end):
+                status, _, pwd = line[len(end):].rstrip(b"\n").partition(b" ")
+                self.cwd = pwd.decode("utf-8", "replace") or self.cwd
+                return self._result(start, int(status), b"".join(output)[:-1])
+            output.append(line)
+
+    def _readline(self, deadline: Optional[float]) -> Optional[bytes]:
+        """Next output line, b"" at EOF, None once `deadline` passes."""
+        fd = self.proc.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while b"\n" not in self._buffer:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    return None
+                if not selector.select(wait):
+                    continue
+                data = os.read(fd, 65536)
+                if not data:
+                    line, self._buffer = self._buffer, b""
+                    return line
+                self._buffer += data
+        line, _, self._buffer = self._buffer.partition(b"\n")
+        return line + b"\n"
+
+    def _result(self, start: float, code: Optional[int], output: bytes, error: str = "", record: bool = True) -> Dict:
+        duration = time.time() - start
+        if record:
+            COMMAND_SECONDS.observe(duration, "ok" if code == 0 else "error")
+        stdout = output.decode("utf-8", "replace")
+        if stdout.endswith("\n"):
+            stdout = stdout[:-1]
+        return {
+            "ok": code == 0,
+            "code": code,
+            "stdout": stdout,
+            "stderr": error,  # command stderr is merged into stdout
+            "duration_sec": round(duration, 4),
+        }
+
+    def close(self, grace: float = 2.0) -> None:
+        """Stop the shell (SIGTERM, SIGKILL after `grace`) and reap it.
+
+        A request still running a command on the session gets a "session closed"
+        error for it; the pipes are closed once that request lets go of them.
+        """
+        self._closed = True
+        try:
+            self.proc.stdin.close()
+        except (OSError, ValueError):
+            pass
+        if self.proc.poll() is None:
+            cancel_command(self.proc, grace)
+        self.proc.wait()
+        with self._io:
+            self.proc.stdout.close()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "pid": self.proc.pid,
+            "alive": self.alive,
+            "busy": self.busy.locked(),
+            "cwd": self.cwd,
+            "created": self.created,
+            "idle_sec": round(time.monotonic() - self.last_used, 3),
+            "commands": self.commands,
+        }
+
+
+class SessionPool:
+    """At most `max_sessions` shells; those idle for `idle_timeout` seconds are closed.
+
+    A reaper thread (started with the first session) closes idle and exited shells.
+    """
+
+    def __init__(self, max_sessions: int = 16, idle_timeout: float = 600.0):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions: "OrderedDict[str, ShellSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._reaper: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self.created = 0
+        self.expired = 0
+
+    def create(self, cwd: Optional[str] = None, env: Optional[Dict[str, str]] = None) -> ShellSession:
+        expired: List[ShellSession] = []
+        try:
+            with self._lock:
+                expired = self._reap()
+                session = self._create(cwd, env)
+        finally:
+            self._close(expired)
+        return session
+
+    def _create(self, cwd: Optional[str], env: Optional[Dict[str, str]]) -> ShellSession:
+        if len(self._sessions) >= self.max_sessions:
+            raise HTTPError(
+                HTTPStatus.SERVICE_UNAVAILABLE,
+                f"Too many shell sessions ({self.max_sessions})",
+                {"Retry-After": str(config.RETRY_AFTER_SEC)},
+            )
+        try:
+            session = ShellSession(cwd, env)
+        except OSError as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Cannot start shell: {e}")
+        self._sessions[session.id] = session
+        self.created += 1
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_idle, name="ps-sessions", daemon=True)
+            self._reaper.start()
+        return session
+
+    def get(self, session_id: str) -> ShellSession:
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, "Session not found")
+        return session
+
+    def run(self, session_id: str, cmds: List[str], timeout: Optional[float] = None, stop_on_error: bool = False) -> Dict:
+        session = self.get(session_id)
+        if not session.busy.acquire(blocking=False):
+            raise HTTPError(
+                HTTPStatus.CONFLICT,
+                "Session is running another request",
+                {"Retry-After": str(config.RETRY_AFTER_SEC)},
+            )
+        try:
+            result = session.run(cmds, timeout=timeout, stop_on_error=stop_on_error)
+        finally:
+            session.busy.release()
+        if not session.alive:
+            self.remove(session_id)
+        return result
+
+    def remove(self, session_id: str) -> Optional[ShellSession]:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.close(config.SHUTDOWN_KILL_GRACE_SEC)
+        return session
+
+    def _reap(self) -> List[ShellSession]:
+        """Drop idle and exited sessions; the caller closes them once `_lock` is released."""
+        now = time.monotonic()
+        expired = []
+        for session in list(self._sessions.values()):
+            idle = not session.busy.locked() and now - session.last_used > self.idle_timeout
+            if idle or not session.alive:
+                del self._sessions[session.id]
+                expired.append(session)
+                self.expired += 1
+        return expired
+
+    @staticmethod
+    def _close(sessions: List[ShellSession]) -> None:
+        # Closing waits for each shell to exit, so it never runs under `_lock`
+        for session in sessions:
+            session.close(config.SHUTDOWN_KILL_GRACE_SEC)
+
+    def _reap_idle(self) -> None:
+        while not self._stopped.wait(min(self.idle_timeout / 2, 30.0)):
+            with self._lock:
+                expired = self._reap()
+            self._close(expired)
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return [s.status() for s in sessions]
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        self._close(sessions)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "busy": sum(1 for s in self._sessions.values() if s.busy.locked()),
+                "created": self.created,
+                "expired": self.expired,
+            }
+
+
+SESSIONS = SessionPool(config.SESSION_MAX, config.SESSION_IDLE_TIMEOUT_SEC)
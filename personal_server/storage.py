@@ -5,7 +5,7 @@ from pathlib import Path
 from typing import Dict, Optional
 
 from . import config
-from .utils import append_csv_row, ensure_dir, slugify, utc_now_str, write_text, short_id
+from .utils import append_csv_row, ensure_dir, read_csv_rows, slugify, utc_now_str, write_text, short_id
 
 
 @dataclass
@@ -36,6 +36,19 @@ def save_note(title: str, content: str, tags: Optional[str] = None) -> NoteRecor
     return rec
 
 
+def get_note(note_id: str) -> Optional[Dict]:
+    """Look up a note by id in notes.csv and attach its Markdown body."""
+    found = None
+    for row in read_csv_rows(config.NOTES_CSV):
+        if row.get("id") == note_id:
+            found = row
+    if found is None:
+        return None
+    path = config.NOTES_DIR / found.get("filename", "")
+    found["content"] = path.read_text(encoding="utf-8") if path.is_file() else ""
+    return found
+
+
 @dataclass
 class TransactionRecord:
     id: str
@@ -0,0 +1,130 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+class Span:
+    __slots__ = ("name", "start", "end", "attrs", "children")
+
+    def __init__(self, name: str, attrs: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attrs = attrs
+        self.children: List[Span] = []
+
+    @property
+    def duration(self) -> float:
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+    def tree(self, origin: float) -> Dict[str, Any]:
+        node: Dict[str, Any] = {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "dur_ms": round(self.duration, 3),
+        }
+        if self.attrs:
+            node["attrs"] = self.attrs
+        if self.children:
+            node["children"] = [c.tree(origin) for c in self.children]
+        return node
+
+
+class _SpanContext:
+    # A class rather than @contextmanager: this sits on hot paths (every CSV append)
+    __slots__ = ("trace", "span")
+
+    def __init__(self, trace: "Trace", name: str, attrs: Optional[Dict[str, Any]]):
+        self.trace = trace
+        self.span = Span(name, attrs)
+
+    def __enter__(self) -> Span:
+        stack = self.trace.stack
+        stack[-1].children.append(self.span)
+        stack.append(self.span)
+        return self.span
+
+    def __exit__(self, *exc: Any) -> None:
+        self.span.end = time.perf_counter()
+        self.trace.stack.pop()
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc: Any) -> None:
+        return None
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Trace:
+    """Span tree for one request, recorded on the thread that runs its handler."""
+
+    def __init__(self, name: str = "request"):
+        self.root = Span(name)
+        self.stack: List[Span] = [self.root]
+
+    def span(self, name: str, **attrs: Any) -> _SpanContext:
+        return _SpanContext(self, name, attrs or None)
+
+    def finish(self) -> None:
+        self.root.end = time.perf_counter()
+
+    @property
+    def total_ms(self) -> float:
+        return self.root.duration
+
+    def server_timing(self) -> str:
+        """Server-Timing header value.
+
+        Repeated span names are summed (two file writes = one "storage"); a span
+        nested in one of the same name is already counted by its ancestor.
+        """
+        totals: Dict[str, float] = {}
+
+        def walk(span: Span, outer: frozenset) -> None:
+            for child in span.children:
+                if child.name not in outer:
+                    totals[child.name] = totals.get(child.name, 0.0) + child.duration
+                walk(child, outer | {child.name})
+
+        walk(self.root, frozenset())
+        parts = [f"{name};dur={dur:.2f}" for name, dur in totals.items()]
+        parts.append(f"total;dur={self.total_ms:.2f}")
+        return ", ".join(parts)
+
+    def tree(self) -> Dict[str, Any]:
+        return self.root.tree(self.root.start)
+
+
+_local = threading.local()
+
+
+def current() -> Optional[Trace]:
+    return getattr(_local, "trace", None)
+
+
+def span(name: str, **attrs: Any):
+    """Time a block as a child of the current span; a no-op outside a traced request."""
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return _NO_SPAN
+    return _SpanContext(trace, name, attrs or None)
+
+
+def start(name: str = "request") -> Trace:
+    trace = Trace(name)
+    _local.trace = trace
+    return trace
+
+
+def stop() -> None:
+    _local.trace = None
+
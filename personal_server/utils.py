@@ -4,10 +4,22 @@ import csv
 import json
 import os
 import re
+import socket
+import stat
+import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, Iterable, Optional
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import tracing
+from .metrics import CSV_APPEND_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # not POSIX: in-process writers only
+    fcntl = None
 
 
 ISO_FORMAT = "%Y-%m-%dT%H-%M-%S.%fZ"
@@ -30,17 +42,113 @@ def slugify(text: str, max_length: int = 80) -> str:
 
 
 def write_text(path: Path, content: str) -> None:
-    path.write_text(content, encoding="utf-8")
+    with tracing.span("storage", file=path.name):
+        path.write_text(content, encoding="utf-8")
+
+
+def lock_file(f: IO, blocking: bool = True) -> bool:
+    """Take an exclusive advisory lock on an open file; released when it is closed.
+
+    Serializes writers across threads and prefork worker processes alike. With
+    `blocking=False`, returns False at once if someone else holds the lock.
+    """
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def unlock_file(f: IO) -> None:
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def unix_listener(path: Path, mode: int = 0o660, backlog: int = 128) -> socket.socket:
+    """Bind and listen on a Unix domain socket at `path` with permissions `mode`.
+
+    A stale socket file left by a crashed server is replaced; any other kind of
+    file at `path` is an error.
+    """
+    try:
+        if stat.S_ISSOCK(os.lstat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    ensure_dir(Path(path).parent)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        # Bind under a restrictive umask so the socket is never briefly world-accessible
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(str(path))
+        finally:
+            os.umask(old_umask)
+        os.chmod(path, mode)
+        sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
 
 
 def append_csv_row(csv_path: Path, fieldnames: Iterable[str], row: Dict[str, object]) -> None:
-    is_new = not csv_path.exists()
+    fieldnames = list(fieldnames)
+    values = {k: _normalize_value(row.get(k)) for k in fieldnames}
+    pending = getattr(_batch, "pending", None)
+    if pending is not None:
+        # Inside csv_batch(): written together when the batch ends
+        pending.setdefault(csv_path, (fieldnames, []))[1].append(values)
+        return
+    write_csv_rows(csv_path, fieldnames, [values])
+
+
+def write_csv_rows(csv_path: Path, fieldnames: List[str], rows: List[Dict[str, str]]) -> None:
+    """Append already-normalized rows with one open, one lock and one write."""
+    start = time.perf_counter()
     ensure_dir(csv_path.parent)
-    with csv_path.open("a", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=list(fieldnames))
+    span = tracing.span("storage", file=csv_path.name, rows=len(rows))
+    with span, csv_path.open("a", newline="", encoding="utf-8") as f:
+        lock_file(f)
+        # Decided under the lock so two processes cannot both write the header
+        is_new = f.seek(0, os.SEEK_END) == 0
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
         if is_new:
             writer.writeheader()
-        writer.writerow({k: _normalize_value(row.get(k)) for k in writer.fieldnames})
+        writer.writerows(rows)
+    CSV_APPEND_SECONDS.observe(time.perf_counter() - start, csv_path.name)
+
+
+_batch = threading.local()
+
+
+@contextmanager
+def csv_batch() -> Iterator[None]:
+    """Group append_csv_row calls on this thread into one write per CSV file.
+
+    Rows are flushed when the block exits, even if it raised; nested blocks join
+    the outermost one.
+    """
+    if getattr(_batch, "pending", None) is not None:
+        yield
+        return
+    pending: Dict[Path, Tuple[List[str], List[Dict[str, str]]]] = {}
+    _batch.pending = pending
+    try:
+        yield
+    finally:
+        _batch.pending = None
+        for csv_path, (fieldnames, rows) in pending.items():
+            write_csv_rows(csv_path, fieldnames, rows)
+
+
+def read_csv_rows(csv_path: Path) -> Iterator[Dict[str, str]]:
+    if not csv_path.exists():
+        return
+    with csv_path.open("r", newline="", encoding="utf-8") as f:
+        yield from csv.DictReader(f)
 
 
 def _normalize_value(v: object) -> str:
@@ -51,8 +159,21 @@ def _normalize_value(v: object) -> str:
     return json.dumps(v, ensure_ascii=False)
 
 
+_id_lock = threading.Lock()
+_id_last = [0, 0]  # [last millisecond handed out, ids already issued in it]
+
+
 def short_id(prefix: str = "") -> str:
-    # time-based unique id, with milliseconds
+    # time-based unique id: milliseconds, then the pid (prefork workers share a clock),
+    # then -1, -2, ... for later ids in the same millisecond (a batch)
     ms = int(time.time() * 1000)
-    return f"{prefix}{ms}"
+    with _id_lock:
+        if ms <= _id_last[0]:
+            ms = _id_last[0]
+            _id_last[1] += 1
+        else:
+            _id_last[:] = [ms, 0]
+        seq = _id_last[1]
+    base = f"{prefix}{ms}-{os.getpid()}"
+    return f"{base}-{seq}" if seq else base
 
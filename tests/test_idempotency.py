@@ -0,0 +1,82 @@
+import multiprocessing
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+from personal_server.idempotency import IdempotencyCache
+from personal_server.router import HTTPError, Response
+
+KEY = "/batch k1"
+
+
+def _worker(path, barrier, results):
+    # One prefork worker: its own cache over the shared journal
+    cache = IdempotencyCache(path)
+    barrier.wait()
+    try:
+        entry = cache.begin(KEY, "fp")
+    except HTTPError as e:
+        results.put(int(e.status))
+        return
+    if entry is not None:
+        results.put("replayed")
+        return
+    results.put("claimed")
+    time.sleep(0.3)
+    cache.finish(KEY, "fp", Response({"ok": True}))
+
+
+class CrossProcessClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "keys.jsonl"
+        self.ctx = multiprocessing.get_context("fork")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _race(self, n):
+        barrier = self.ctx.Barrier(n)
+        results = self.ctx.Queue()
+        procs = [self.ctx.Process(target=_worker, args=(self.path, barrier, results)) for _ in range(n)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join(10)
+        return sorted(str(results.get(timeout=1)) for _ in procs)
+
+    def test_only_one_worker_claims_a_key(self):
+        outcomes = self._race(6)
+        self.assertEqual(outcomes.count("claimed"), 1, outcomes)
+        self.assertEqual(outcomes.count("409"), 5, outcomes)
+
+    def test_later_workers_replay_the_stored_response(self):
+        self._race(2)
+        self.assertEqual(self._race(3), ["replayed"] * 3)
+
+    def test_claim_is_released_without_storing(self):
+        first = IdempotencyCache(self.path)
+        self.assertIsNone(first.begin(KEY, "fp"))
+        with self.assertRaises(HTTPError) as raised:
+            IdempotencyCache(self.path).begin(KEY, "fp")
+        self.assertEqual(raised.exception.status, 409)
+        first.finish(KEY, "fp", None)
+        self.assertIsNone(IdempotencyCache(self.path).begin(KEY, "fp"))
+
+    def test_compaction_keeps_other_workers_entries(self):
+        mine, theirs = IdempotencyCache(self.path), IdempotencyCache(self.path)
+        self.assertIsNone(mine.begin("/notes mine", None))
+        # Appended after `mine` last read the journal, just before its write triggers a compaction
+        self.assertIsNone(theirs.begin("/notes theirs", None))
+        theirs.finish("/notes theirs", None, Response({"ok": True}))
+        mine._journal_lines = 2 * mine.max_entries
+        mine.finish("/notes mine", None, Response({"ok": True}))
+        self.assertEqual(mine._journal_lines, 2)
+        fresh = IdempotencyCache(self.path)
+        self.assertIsNotNone(fresh.begin("/notes theirs", None))
+        self.assertIsNotNone(fresh.begin("/notes mine", None))
+
+
+if __name__ == "__main__":
+    unittest.main()